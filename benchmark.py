@@ -0,0 +1,558 @@
+"""
+Offline benchmark of the polling, caching and delivery path. Local stand-ins of Pixiv app API, image CDN and
+mirai-api-http are served on 127.0.0.1 with a synthetic bookmark collection, so nothing leaves this machine.
+Results are written as JSON for comparing releases.
+
+    python benchmark.py --illusts 10000 --new 60 --polls 5 --output bench.json
+"""
+import argparse
+import asyncio
+import bisect
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import config
+import log
+
+_page_size = 30  # Same as Pixiv
+
+
+# STUB SERVERS
+
+class SyntheticCollection:
+    """
+    Bookmarks of one user, newest first. Illust json is generated on demand from its pid, so collections of
+    100k illusts cost only the list of pids. Bookmark id of an illust is its pid.
+    """
+    _pids: list  # Ascending
+    _seed: int
+    _manga_ratio: float
+    _max_pages: int
+    _restricted_ratio: float
+    _cdn: str
+    _lock: threading.Lock
+
+    def __init__(self, size: int, cdn: str, manga_ratio: float = 0.3, max_pages: int = 5,
+                 restricted_ratio: float = 0.05, seed: int = 0):
+        self._pids = list(range(10000000, 10000000 + size))
+        self._seed = seed
+        self._manga_ratio = manga_ratio
+        self._max_pages = max(2, max_pages)
+        self._restricted_ratio = restricted_ratio
+        self._cdn = cdn
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pids)
+
+    def bookmark(self, count: int) -> list:
+        """Bookmark count new illusts on top of the collection."""
+        with self._lock:
+            top = self._pids[-1] + 1 if len(self._pids) > 0 else 10000000
+            new = list(range(top, top + count))
+            self._pids.extend(new)
+        return new
+
+    def getPageCount(self, pid: int) -> int:
+        r = random.Random(pid * 31 + self._seed)
+        if r.random() < self._manga_ratio:
+            return r.randint(2, self._max_pages)
+        return 1
+
+    def getImageCount(self) -> int:
+        return sum(self.getPageCount(p) for p in self._pids)
+
+    def illust(self, pid: int) -> dict:
+        r = random.Random(pid * 31 + self._seed)
+        pages = self.getPageCount(pid)
+        uid = r.randint(1, 2000)
+        urls = [f"{self._cdn}/img-original/img/2021/01/01/00/00/00/{pid}_p{i}.png" for i in range(pages)]
+        square = {"square_medium": urls[0], "medium": urls[0], "large": urls[0]}
+        return {
+            "id": pid,
+            "title": f"illust {pid}",
+            "type": "manga" if pages > 1 else "illust",
+            "image_urls": square,
+            "caption": "",
+            "restrict": 0,
+            "user": {"id": uid, "name": f"user {uid}", "account": f"user{uid}",
+                     "profile_image_urls": {"medium": urls[0]}, "is_followed": False},
+            "tags": [{"name": f"tag{r.randint(0, 199)}", "translated_name": None} for _ in range(r.randint(3, 8))],
+            "tools": [],
+            "create_date": "2021-01-01T00:00:00+09:00",
+            "page_count": pages,
+            "width": 2000,
+            "height": 3000,
+            "sanity_level": 2,
+            "x_restrict": 1 if r.random() < self._restricted_ratio else 0,
+            "series": None,
+            "meta_single_page": {"original_image_url": urls[0]} if pages == 1 else {},
+            "meta_pages": [] if pages == 1 else [{"image_urls": dict(square, original=u)} for u in urls],
+            "total_view": r.randint(0, 100000),
+            "total_bookmarks": r.randint(0, 10000),
+            "is_bookmarked": True,
+            "visible": True,
+            "is_muted": False,
+        }
+
+    def page(self, user_id: str, restrict: str, max_bookmark_id: str = None) -> dict:
+        with self._lock:
+            end = len(self._pids) if max_bookmark_id is None else bisect.bisect_right(self._pids, int(max_bookmark_id))
+            start = max(0, end - _page_size)
+            pids = self._pids[start:end][::-1]
+            nxt = None
+            if start > 0:
+                nxt = (f"https://app-api.pixiv.net/v1/user/bookmarks/illust?user_id={user_id}&restrict={restrict}"
+                       f"&filter=for_ios&max_bookmark_id={self._pids[start - 1]}")
+        return {"illusts": [self.illust(p) for p in pids], "next_url": nxt}
+
+
+class StubServer:
+    """ThreadingHTTPServer on an ephemeral port which counts requests per path."""
+    _server: ThreadingHTTPServer
+    _thread: threading.Thread
+    _requests: Counter
+    _bytes: int
+    _lock: threading.Lock
+
+    def __init__(self, handler: type):
+        stub = self
+
+        class _Handler(handler):
+            server_stub = stub
+
+        self._requests = Counter()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"stub-{handler.__name__}",
+                                        daemon=True)
+        self._thread.start()
+
+    def getUrl(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def getPort(self) -> int:
+        return self._server.server_address[1]
+
+    def count(self, path: str, sent: int):
+        with self._lock:
+            self._requests[path] += 1
+            self._bytes += sent
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"requests": dict(self._requests), "total": sum(self._requests.values()), "bytes": self._bytes}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real servers
+    server_stub: StubServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                n = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if n == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(n)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, body: bytes, content_type: str = "application/json", status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.server_stub.count(urlparse(self.path).path, len(body))  # Before client could see the reply
+        self.wfile.write(body)
+
+    def _reply_json(self, obj, status: int = 200):
+        self._reply(json.dumps(obj).encode("utf-8"), status=status)
+
+
+class PixivApiHandler(_StubHandler):
+    collection: SyntheticCollection
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        qs = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/v1/user/bookmarks/illust":
+            self._reply_json(self.collection.page(qs["user_id"], qs.get("restrict", "public"),
+                                                  qs.get("max_bookmark_id")))
+        elif url.path == "/v1/illust/detail":
+            self._reply_json({"illust": self.collection.illust(int(qs["illust_id"]))})
+        elif url.path == "/v1/user/detail":
+            self._reply_json({"user": {"id": int(qs["user_id"])}})
+        else:
+            self._reply_json({"error": {"message": "Not found", "reason": "", "user_message": ""}}, 404)
+
+
+class CdnHandler(_StubHandler):
+    payload: bytes
+
+    def do_GET(self):
+        self._reply(self.payload, "image/png" if self.path.endswith(".png") else "image/jpeg")
+
+
+class MiraiHandler(_StubHandler):
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self._read_body()
+        if path == "/verify":
+            self._reply_json({"code": 0, "session": "benchmark"})
+        elif path == "/uploadImage":
+            n = self.server_stub.snapshot()["requests"].get(path, 0)
+            self._reply_json({"imageId": f"{{00000000-0000-0000-0000-{n:012d}}}.jpg", "url": None, "path": None})
+        elif path in ("/sendGroupMessage", "/sendFriendMessage"):
+            self._reply_json({"code": 0, "msg": "success", "messageId": 1})
+        else:
+            self._reply_json({"code": 0, "msg": "success"})
+
+
+# MEASUREMENT
+
+class DbTrace:
+    """Count statements executed through picdb, grouped by their first keyword."""
+    _counts: Counter
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, statement: str):
+        kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "empty"
+        with self._lock:
+            self._counts[kind] += 1
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self._counts)
+
+
+def _summary(values: list) -> dict:
+    if len(values) == 0:
+        return {}
+    s = sorted(values)
+    return {
+        "count": len(s),
+        "min": s[0],
+        "median": statistics.median(s),
+        "p95": s[min(len(s) - 1, math.ceil(len(s) * 0.95) - 1)],
+        "max": s[-1],
+        "mean": statistics.fmean(s),
+    }
+
+
+def _diff(after: dict, before: dict) -> dict:
+    return {k: after.get(k, 0) - before.get(k, 0) for k in after.keys() if after.get(k, 0) != before.get(k, 0)}
+
+
+def _rss_kb() -> int:
+    try:
+        import resource
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r // 1024 if sys.platform == "darwin" else r
+    except ImportError:
+        return None
+
+
+class Bench:
+    _stubs: dict
+    _trace: DbTrace
+    _memory: bool
+    _phases: dict
+
+    def __init__(self, stubs: dict, trace: DbTrace, memory: bool):
+        self._stubs = stubs
+        self._trace = trace
+        self._memory = memory
+        self._phases = {}
+
+    @contextlib.contextmanager
+    def measure(self, phase: str, extra: dict = None):
+        """Record latency, requests to each stub, statements and memory of one run of phase."""
+        http = {n: s.snapshot() for n, s in self._stubs.items()}
+        db = self._trace.snapshot()
+        if self._memory:
+            tracemalloc.reset_peak()
+        st = time.perf_counter()
+        run = {} if extra is None else extra
+        try:
+            yield run
+        finally:
+            run["seconds"] = time.perf_counter() - st
+            run["db"] = _diff(self._trace.snapshot(), db)
+            run["db"]["total"] = sum(run["db"].values())
+            for n, s in self._stubs.items():
+                after = s.snapshot()
+                run[f"{n}_requests"] = after["total"] - http[n]["total"]
+                run[f"{n}_bytes"] = after["bytes"] - http[n]["bytes"]
+            if self._memory:
+                run["peak_alloc_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+            self._phases.setdefault(phase, []).append(run)
+
+    def report(self) -> dict:
+        result = {}
+        for phase, runs in self._phases.items():
+            r = {"runs": runs, "seconds": _summary([x["seconds"] for x in runs])}
+            r["db_statements"] = _summary([x["db"]["total"] for x in runs])
+            result[phase] = r
+        return result
+
+
+# SCENARIO
+
+def _prepare_appdata(root: str):
+    config.data_path = root + "/appdata"
+    config.cache_path = config.data_path + "/cache"
+    config.config_filepath = config.data_path + "/config.yml"
+    config.database_filepath = config.data_path + "/info.db"
+    config.create_appdata()
+
+
+def _make_conf(args, uid: str) -> config.BotConf:
+    conf = config.BotConf()
+    conf.login_qq = 10000
+    conf.pixiv_user_name = "benchmark"
+    conf.pixiv_user_watch_uid = uid
+    conf.response_group = list(range(100001, 100001 + args.groups))
+    conf.check_bookmark_new_sending_limit = args.limit
+    conf.check_bookmark_max_pages = args.max_pages
+    conf.download_worker_count = args.download_workers
+    conf.upload_transcode = args.transcode
+    conf.ratelimit_api_rate = args.api_rate
+    conf.ratelimit_api_burst = max(1, int(args.api_rate))
+    conf.ratelimit_image_rate = args.image_rate
+    conf.ratelimit_image_burst = max(1, int(args.image_rate))
+    return conf
+
+
+def _make_payload(args) -> bytes:
+    if args.transcode:
+        from PIL import Image
+        # Smooth noise compresses like an illustration, not like pure noise.
+        img = Image.effect_noise((args.image_edge // 16, args.image_edge * 3 // 32), 96).convert("RGB")
+        img = img.resize((args.image_edge, args.image_edge * 3 // 2), Image.BICUBIC)
+        buf = io.BytesIO()
+        img.save(buf, "PNG")
+        return buf.getvalue()
+    return random.Random(0).randbytes(args.image_kb * 1024)
+
+
+def _load_delivery():
+    """mirai_core is only needed for the delivery phase, it may not import on every interpreter."""
+    try:
+        import delivery
+        from mirai_core import Bot
+        return delivery, Bot
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def run(args) -> dict:
+    root = tempfile.mkdtemp(prefix="pixiv-bench-")
+    _prepare_appdata(root)
+
+    import imgcache
+    import picdb
+    import pixiv_action
+    import pixiv_oauth
+    import ratelimit
+    import transcode
+    from pixivpy3 import AppPixivAPI
+
+    cdn = StubServer(type("Cdn", (CdnHandler,), {"payload": _make_payload(args)}))
+    collection = SyntheticCollection(args.illusts, cdn.getUrl(), args.manga_ratio, args.max_manga_pages,
+                                     seed=args.seed)
+    api = StubServer(type("PixivApi", (PixivApiHandler,), {"collection": collection}))
+    mirai = StubServer(MiraiHandler)
+    stubs = {"api": api, "cdn": cdn, "mirai": mirai}
+    trace = DbTrace()
+    bench = Bench(stubs, trace, args.memory)
+    delivery, bot_type = _load_delivery()
+    result = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "sqlite": sqlite3.sqlite_version,
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": vars(args),
+        "collection": {"illusts": len(collection), "images": collection.getImageCount()},
+    }
+    if args.memory:
+        tracemalloc.start()
+
+    try:
+        uid = "1"
+        conf = _make_conf(args, uid)
+        with bench.measure("startup"):
+            picdb.load_db()
+            imgcache.load_cache(conf)
+        picdb.add_trace_callback(trace)
+
+        app = ratelimit.RateLimitedApp(AppPixivAPI(), conf)
+        app.hosts = api.getUrl()
+        pixiv_oauth._update_app(app, conf, {"access_token": "benchmark", "refresh_token": "benchmark",
+                                            "expires_in": 86400, "user": {"id": uid}})
+
+        # Catch up the whole collection once, which is what a first start with an old baseline looks like.
+        conf.check_bookmark_max_pages = math.ceil(len(collection) / _page_size) + 1
+        with bench.measure("initial_walk") as r:
+            r["images"] = pixiv_action.poll_bookmarks(app, conf)
+        conf.check_bookmark_max_pages = args.max_pages
+        # The catch-up is not sent, so the outbox only holds what incremental polls find.
+        picdb.discard_outbox(picdb.claim_outbox(conf.watcher_name, collection.getImageCount()), conf.watcher_name)
+
+        for _ in range(args.polls):
+            with bench.measure("idle_poll") as r:
+                r["images"] = pixiv_action.poll_bookmarks(app, conf)
+
+        loop = asyncio.new_event_loop()
+        bot = None
+        if delivery is not None:
+            bot = bot_type(conf.login_qq, "127.0.0.1", mirai.getPort(), "benchmark", loop=loop, scheme="http")
+            loop.run_until_complete(bot.handshake())
+        else:
+            result["delivery_skipped"] = bot_type
+
+        for _ in range(args.polls):
+            collection.bookmark(args.new)
+            with bench.measure("incremental_poll") as r:
+                r["queued"] = pixiv_action.poll_bookmarks(app, conf)
+                indexes = picdb.claim_outbox(conf.watcher_name, conf.check_bookmark_new_sending_limit)
+                r["images"] = len(indexes)
+
+            with bench.measure("download") as r:
+                caches = picdb.create_caches(app, conf, indexes)
+                done = [c for c in caches if c.isSuccess() and not c.isSkipped()]
+                size = sum(c.getSize() for c in done)
+                r["images"] = len(done)
+                r["bytes"] = size
+            r["mb_per_second"] = size / 1024 / 1024 / r["seconds"] if r["seconds"] > 0 else None
+            cached = [c.getIndex() for c in caches if c.isSuccess()]
+            failed = [c.getIndex() for c in caches if not c.isSuccess()]
+
+            with bench.measure("transcode") as r:
+                picdb.set_outbox_state(cached, picdb.outbox_state.uploading, conf.watcher_name)
+                paths = loop.run_until_complete(transcode.prepare_uploads(conf, cached))
+                r["transcoded"] = sum(1 for i in cached if paths[i] != i.getCacheLocalFilePath())
+
+            sent = cached
+            if bot is not None:
+                with bench.measure("delivery") as r:
+                    results = loop.run_until_complete(delivery.deliver_images(bot, conf, cached, paths=paths))
+                    picdb.write_deliveries({d.getIndex(): d.getSentGroups() for d in results}, conf.watcher_name)
+                    sent = [d.getIndex() for d in results if d.isSent()]
+                    r["images"] = len(sent)
+
+            with bench.measure("history") as r:
+                if len(sent) > 0:
+                    picdb.complete_outbox(picdb.history_action_type.bookmark_modification_post, sent,
+                                          conf.watcher_name)
+                failed += [i for i in cached if i not in sent]
+                if len(failed) > 0:
+                    picdb.retry_outbox(conf, failed, "benchmark", conf.watcher_name)
+                r["images"] = len(sent)
+
+        # Lookups of pids which have been seen are served from illust cache.
+        sample = random.Random(args.seed).sample(range(len(collection)), min(args.lookups, len(collection)))
+        pids = [collection._pids[i] for i in sample]
+        with bench.measure("illust_lookup") as r:
+            for p in pids:
+                pixiv_action.get_illust_detail(app, conf, str(p))
+            r["lookups"] = len(pids)
+
+        if bot is not None:
+            loop.run_until_complete(bot.release())
+            loop.run_until_complete(bot.session.close())
+        loop.close()
+
+        result["phases"] = bench.report()
+        result["database_bytes"] = os.path.getsize(config.database_filepath)
+        result["cache_bytes"] = imgcache.get_total_size()
+        result["ratelimit"] = ratelimit.get_budget()
+        result["max_rss_kb"] = _rss_kb()
+    finally:
+        if args.memory:
+            tracemalloc.stop()
+        picdb.remove_trace_callback(trace)
+        picdb.clean_up_db()
+        transcode.shutdown()
+        for s in stubs.values():
+            s.close()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+        else:
+            result["appdata"] = config.data_path
+    return result
+
+
+def main(argv: list = None) -> int:
+    p = argparse.ArgumentParser(description="Offline benchmark against local stub Pixiv and Mirai servers.")
+    p.add_argument("--illusts", type=int, default=1000, help="Size of synthetic bookmark collection")
+    p.add_argument("--new", type=int, default=30, help="Illusts bookmarked before each incremental poll")
+    p.add_argument("--polls", type=int, default=5, help="Runs of idle and incremental polls")
+    p.add_argument("--limit", type=int, default=15, help="check_bookmark_new_sending_limit")
+    p.add_argument("--max-pages", type=int, default=5, help="check_bookmark_max_pages of regular polls")
+    p.add_argument("--manga-ratio", type=float, default=0.3)
+    p.add_argument("--max-manga-pages", type=int, default=5)
+    p.add_argument("--groups", type=int, default=3, help="Response groups to deliver to")
+    p.add_argument("--image-kb", type=int, default=512, help="Size of each served image")
+    p.add_argument("--transcode", action="store_true", help="Serve real images and transcode them, needs Pillow")
+    p.add_argument("--image-edge", type=int, default=2400, help="Width of served image with --transcode")
+    p.add_argument("--download-workers", type=int, default=4)
+    p.add_argument("--api-rate", type=float, default=1000, help="Rate limit of API requests per second")
+    p.add_argument("--image-rate", type=float, default=1000, help="Rate limit of image requests per second")
+    p.add_argument("--lookups", type=int, default=200, help="Illust detail lookups of known pids")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--memory", action="store_true", help="Trace allocation peak of each phase (slower)")
+    p.add_argument("--keep", action="store_true", help="Keep temporary appdata for inspection")
+    p.add_argument("--verbose", action="store_true", help="Show bot logs on stderr")
+    p.add_argument("--output", help="Write JSON result to file instead of stdout")
+    args = p.parse_args(argv)
+
+    log.configure(level="debug" if args.verbose else "error", console=args.verbose, stream=sys.stderr)
+    result = run(args)
+    log.flush()
+
+    text = json.dumps(result, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import copy
 import os.path as path
 import os
 import yaml
@@ -10,6 +11,33 @@ config_filepath = data_path + "/config.yml"
 database_filepath = data_path + "/info.db"
 
 
+# Filter keys, which can be overridden per response group and per watcher.
+filter_keys = (
+    "show_policy_limited_image",
+    "image_tag_filter_as_whitelist",
+    "image_tag_filter",
+    "image_uid_filter_as_whitelist",
+    "image_uid_filter",
+    "image_pid_filter_as_whitelist",
+    "image_pid_filter",
+)
+
+# Keys of an item in 'watchers' -> (BotConf attribute, accepted types)
+_watcher_keys = {
+    "name": ("watcher_name", (str,)),
+    "uid": ("pixiv_user_watch_uid", (str, int)),
+    "restrict": ("check_bookmark_restrict", (str,)),
+    "baseline": ("check_bookmark_baseline_uid", (str, int)),
+    "groups": ("response_group", (list,)),
+    "interval": ("check_bookmark_new", (int,)),
+    "limit": ("check_bookmark_new_sending_limit", (int,)),
+    "max_pages": ("check_bookmark_max_pages", (int,)),
+    "max_walk_pages": ("check_bookmark_max_walk_pages", (int,)),
+    "filters": (None, (dict,)),
+    "group_filters": ("response_group_filter", (dict,)),
+}
+
+
 # Read Config
 
 
@@ -61,16 +89,83 @@ class BotConf:
     pixiv_user_name: str = None
     pixiv_user_pwd: str = None
     pixiv_user_watch_uid: str = None
-    token_expired_test_interval: int = 3000
+    token_refresh_margin: int = 300  # Refresh access token this many seconds before it expires
+    token_login_max_attempts: int = 5
+    token_refresh_max_attempts: int = 4  # Refresh grant attempts on network or server errors
 
-    # Watcher
-    schedule_update_interval: float = 1
+    # Rate limit of Pixiv, requests per second. Rates are halved when throttled and recover slowly.
+    ratelimit_api_rate: float = 1
+    ratelimit_api_burst: int = 5
+    ratelimit_image_rate: float = 8
+    ratelimit_image_burst: int = 16
+    ratelimit_backoff_base: float = 2  # Seconds
+    ratelimit_backoff_cap: float = 120  # Seconds
+    ratelimit_max_retries: int = 5
+
+    # Watcher, those check_bookmark_* keys and filters are used as defaults of items in 'watchers'.
+    watchers: list = []  # Empty means one watcher made of the keys below
+    watcher_name: str = ""  # Scope of history and high-water mark. Set per watcher, not in config file.
+    schedule_jitter: float = 5  # Seconds
+    schedule_job_timeout: float = 600  # Seconds
     response_group: list = []
     check_bookmark_new: int = 1
     check_bookmark_new_sending_limit: int = 15
-    check_bookmark_baseline_uid: str = None
+    check_bookmark_baseline_uid: str = None  # Only used before the first completed cycle
+    check_bookmark_max_pages: int = 5  # Pages walked by one cycle
+    check_bookmark_max_walk_pages: int = 50  # Pages a walk resumed over several cycles may cover at most
     check_bookmark_restrict: str = "public"
 
+    # Instances sharing one database take turns through leases of jobs
+    instance_id: str = None  # Owner name of leases, host name and pid if None
+    lease_ttl: float = 120  # Seconds a lease survives without heartbeat of its owner
+
+    # Download
+    download_worker_count: int = 4
+    download_timeout: float = 60
+    download_resume_attempts: int = 3  # Range requests continuing an interrupted download
+    cache_size_limit_mb: int = 2048  # 0 means unlimited
+    illust_cache_ttl: int = 86400  # Seconds to trust cached illust json, 0 disables the cache
+
+    # Outbox, images found by a cycle are queued and sent in later cycles if they do not fit in one
+    outbox_max_attempts: int = 5
+    outbox_retry_base: float = 60  # Seconds before the first retry, doubled by each attempt
+    outbox_retry_cap: float = 3600  # Seconds
+
+    # Prefetch, images of upcoming cycles are downloaded after each cycle so sending them only has to upload
+    prefetch_max_mb: int = 64  # Downloaded per cycle at most, 0 disables prefetch
+    prefetch_lookahead: int = 3  # Cycles to look ahead
+    prefetch_cache_share: float = 0.25  # Share of cache_size_limit_mb which may hold prefetched images
+
+    # History retention, older history is rolled up into a compact sent-set and the database is vacuumed
+    history_retention_days: int = 90  # 0 keeps all history detailed
+    history_compact_interval: float = 6  # Hours
+
+    # Near-duplicate suppression, requires Pillow
+    dedup_max_distance: int = 5  # Bits of dHash two images may differ in to be duplicates, -1 disables it
+
+    # Upload transcoding, requires Pillow
+    upload_transcode: bool = True
+    upload_transcode_min_kb: int = 1024  # Smaller originals are uploaded as is
+    upload_max_edge: int = 2048
+    upload_jpeg_quality: int = 85
+    transcode_worker_count: int = 2
+
+    # Delivery
+    delivery_upload_concurrency: int = 2
+    delivery_group_concurrency: int = 4
+
+    # Logging
+    log_level: str = "debug"  # debug, info, warn or error
+    log_format: str = "text"  # text or json (one object per line)
+    log_console: bool = True
+    log_file: str = None  # Also write logs into this file, rotated by size
+    log_file_max_kb: int = 10240
+    log_file_backups: int = 3
+
+    # Metrics in Prometheus text format, served at http://metrics_host:metrics_port/metrics
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0  # 0 disables metrics
+
     # Filter
     show_policy_limited_image: int = 0
     image_tag_filter_as_whitelist: bool = False
@@ -79,7 +174,7 @@ class BotConf:
     image_uid_filter: list = []
     image_pid_filter_as_whitelist: bool = False
     image_pid_filter: list = []
-
+    response_group_filter: dict = {}  # group -> filter keys above, overriding them for that group
 
 
 def load_config() -> BotConf:
@@ -90,6 +185,8 @@ def load_config() -> BotConf:
         def _load(val: str, type) -> bool:
             if val in ycf:
                 v = ycf[val]
+                if (type is float) and isinstance(v, int) and not isinstance(v, bool):
+                    v = float(v)  # YAML reads a whole number like 120 as int
                 if not isinstance(v, type):
                     raise TypeError(f"'{val}' should be {str(type)}.")
                 setattr(conf, val, v)
@@ -127,18 +224,108 @@ def load_config() -> BotConf:
                       "your local is accept those kind of content.")
 
         _load("response_group", list)
-        _load("token_expired_test_interval", int)
-        _load("schedule_update_interval", float)
+        _load("token_refresh_margin", int)
+        _load("token_login_max_attempts", int)
+        _load("token_refresh_max_attempts", int)
+        _load("ratelimit_api_rate", float)
+        _load("ratelimit_api_burst", int)
+        _load("ratelimit_image_rate", float)
+        _load("ratelimit_image_burst", int)
+        _load("ratelimit_backoff_base", float)
+        _load("ratelimit_backoff_cap", float)
+        _load("ratelimit_max_retries", int)
+        _load("schedule_jitter", float)
+        _load("schedule_job_timeout", float)
         _load("response_group", list)
-        _load("check_bookmark_new_interval", int)
+        _load("check_bookmark_new", int)
         _load("check_bookmark_new_sending_limit", int)
         _load("check_bookmark_baseline_uid", str)
+        _load("check_bookmark_max_pages", int)
+        _load("check_bookmark_max_walk_pages", int)
         _load("check_bookmark_restrict", str)
+        _load("instance_id", str)
+        _load("lease_ttl", float)
+        _load("download_worker_count", int)
+        _load("download_timeout", float)
+        _load("download_resume_attempts", int)
+        _load("cache_size_limit_mb", int)
+        _load("illust_cache_ttl", int)
+        _load("outbox_max_attempts", int)
+        _load("outbox_retry_base", float)
+        _load("outbox_retry_cap", float)
+        _load("prefetch_max_mb", int)
+        _load("prefetch_lookahead", int)
+        _load("prefetch_cache_share", float)
+        _load("dedup_max_distance", int)
+        _load("history_retention_days", int)
+        _load("history_compact_interval", float)
+        _load("upload_transcode", bool)
+        _load("upload_transcode_min_kb", int)
+        _load("upload_max_edge", int)
+        _load("upload_jpeg_quality", int)
+        _load("transcode_worker_count", int)
+        _load("delivery_upload_concurrency", int)
+        _load("delivery_group_concurrency", int)
+        _load("log_level", str)
+        _load("log_format", str)
+        _load("log_console", bool)
+        _load("log_file", str)
+        _load("log_file_max_kb", int)
+        _load("log_file_backups", int)
+        _load("metrics_host", str)
+        _load("metrics_port", int)
         _load("image_pid_filter_as_whitelist", bool)
         _load("image_tag_filter_as_whitelist", bool)
         _load("image_uid_filter_as_whitelist", bool)
         _load("image_pid_filter", list)
         _load("image_tag_filter", list)
         _load("image_uid_filter", list)
+        _load("response_group_filter", dict)
+        _load("watchers", list)
 
     return conf
+
+
+def build_watchers(conf: BotConf) -> list:
+    """
+    Make a BotConf for each item of 'watchers', based on conf and overridden by the item. Without 'watchers',
+    conf itself is the only watcher. App, database, image cache and rate limiter are shared by all of them.
+    """
+    if len(conf.watchers) == 0:
+        return [conf]
+
+    result = []
+    names = set()
+    for n, item in enumerate(conf.watchers):
+        if not isinstance(item, dict):
+            raise TypeError(f"Item {n} of 'watchers' should be {str(dict)}.")
+        unknown = set(item.keys()) - set(_watcher_keys.keys())
+        if len(unknown) > 0:
+            raise AttributeError(f"Unknown key {sorted(unknown)} in item {n} of 'watchers'.")
+
+        w = copy.copy(conf)
+        w.watchers = []
+        for key, (attr, types) in _watcher_keys.items():
+            if key not in item:
+                continue
+            v = item[key]
+            if not isinstance(v, types):
+                raise TypeError(f"'{key}' of item {n} of 'watchers' should be {' or '.join(str(t) for t in types)}.")
+            if attr is not None:
+                setattr(w, attr, str(v) if str in types and int in types else v)
+
+        filters = item.get("filters", {})
+        unknown = set(filters.keys()) - set(filter_keys)
+        if len(unknown) > 0:
+            raise AttributeError(f"Unknown filter key {sorted(unknown)} in item {n} of 'watchers'.")
+        for k, v in filters.items():
+            setattr(w, k, v)
+
+        if w.watcher_name in names:
+            raise AttributeError(f"Name '{w.watcher_name}' of item {n} of 'watchers' is not unique, "
+                                 f"give every watcher a different name.")
+        names.add(w.watcher_name)
+        if w.pixiv_user_watch_uid is None:
+            raise AttributeError(f"'uid' of item {n} of 'watchers' is required when watching uid is unknown.")
+        result.append(w)
+    return result
@@ -0,0 +1,170 @@
+import threading
+import config as _config
+import log
+import metrics
+import picdb
+import scheduler
+import transcode
+
+_bits = 64
+
+
+if hasattr(int, "bit_count"):  # Python 3.10
+    def hamming_distance(a: int, b: int) -> int:
+        return (a ^ b).bit_count()
+else:
+    def hamming_distance(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
+
+
+class HashIndex:
+    """
+    Multi-index hashing of 64 bit hashes. A hash is cut into max_distance + 1 segments, and any hash within
+    max_distance bits of it equals it in at least one whole segment, so a lookup only compares the hashes which
+    share a segment with it instead of all of them.
+    """
+    _max_distance: int
+    _segments: list  # (shift, mask) of each segment
+    _tables: list  # One dict per segment: segment value -> list of (hash, tag)
+    _size: int
+
+    def __init__(self, max_distance: int):
+        self._max_distance = max_distance
+        count = min(_bits, max_distance + 1)
+        self._segments = []
+        shift = 0
+        for n in range(count):
+            width = _bits // count + (1 if n < _bits % count else 0)
+            self._segments.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in self._segments]
+        self._size = 0
+
+    def getSize(self) -> int:
+        return self._size
+
+    def add(self, h: int, tag):
+        for (shift, mask), table in zip(self._segments, self._tables):
+            table.setdefault((h >> shift) & mask, []).append((h, tag))
+        self._size += 1
+
+    def find(self, h: int, exclude=None) -> tuple:
+        """(hash, tag) of the closest hash within max_distance, None if there is none. exclude(tag) may skip some."""
+        best = None
+        best_distance = self._max_distance + 1
+        for (shift, mask), table in zip(self._segments, self._tables):
+            for c in table.get((h >> shift) & mask, ()):
+                d = hamming_distance(h, c[0])
+                if (d < best_distance) and ((exclude is None) or (not exclude(c[1]))):
+                    best = c
+                    best_distance = d
+        return best
+
+    def find_all(self, h: int, exclude=None) -> list:
+        """(hash, tag) of every hash within max_distance. exclude(tag) may skip some."""
+        found = {}
+        for (shift, mask), table in zip(self._segments, self._tables):
+            for c in table.get((h >> shift) & mask, ()):
+                if (hamming_distance(h, c[0]) <= self._max_distance) and ((exclude is None) or (not exclude(c[1]))):
+                    found[c] = None  # Shares several segments with h
+        return list(found)
+
+
+def is_enabled(conf: _config.BotConf) -> bool:
+    return (conf.dedup_max_distance >= 0) and transcode.is_available()
+
+
+# Hashes of sent images by scope of watcher, tagged with (pid, index).
+_sent: dict = {}
+_sent_action_id = 0
+_sent_distance: int = None
+_lock = threading.Lock()
+
+
+def refresh(conf: _config.BotConf) -> int:
+    """Index hashes of images sent since the last refresh, including those sent by other instances."""
+    global _sent, _sent_action_id, _sent_distance
+    if not is_enabled(conf):
+        return 0
+    with _lock:
+        if _sent_distance != conf.dedup_max_distance:
+            _sent = {}
+            _sent_action_id = 0
+            _sent_distance = conf.dedup_max_distance
+        # Hashes are stored before images are sent, so an action never gets hashes after it has been read.
+        last = picdb.query_last_action_id()
+        rows = picdb.query_sent_hashes(_sent_action_id, last)
+        for scope, pid, index, h in rows:
+            if scope not in _sent:
+                _sent[scope] = HashIndex(conf.dedup_max_distance)
+            _sent[scope].add(h, (pid, index))
+        _sent_action_id = last
+    return len(rows)
+
+
+async def hash_cached(conf: _config.BotConf, indexes: list) -> dict:
+    """dHash of each cached ImageRecordIndex, computed once and stored. Those which can not be hashed are left out."""
+    hashes = await scheduler.run_blocking(picdb.query_image_hashes, indexes)
+    missing = [i for i in indexes if i not in hashes]
+    if len(missing) > 0:
+        computed = await transcode.hash_images(conf, missing)
+        if len(computed) > 0:
+            await scheduler.run_blocking(picdb.write_image_hashes, computed)
+        hashes.update(computed)
+    return hashes
+
+
+def filter_duplicates(conf: _config.BotConf, indexes: list, hashes: dict, targets: dict,
+                      scope: str = "") -> tuple:
+    """
+    Leave groups which have received a near-duplicate of an ImageRecordIndex out of its targets. Near-duplicates
+    are images sent by watcher of scope, and earlier ones of the same list. Pages of the same illust are never
+    duplicates of each other. A sent image without delivery records (rolled up, or sent before they were kept)
+    counts as received by every group. targets is updated in place.
+    Returns (unique, duplicates), where duplicates are those without any group left.
+    """
+    if not is_enabled(conf):
+        return list(indexes), []
+    with _lock:
+        sent = _sent.get(scope)
+        matches = {}
+        for i in indexes:
+            h = hashes.get(i)
+            if (h is not None) and (sent is not None):
+                pid = i.getParent().getPid()
+                matches[i] = sent.find_all(h, lambda tag: tag[0] == pid)
+    delivered = picdb.query_delivered_groups({c[1] for found in matches.values() for c in found})
+
+    unique = []
+    duplicates = []
+    batch = HashIndex(conf.dedup_max_distance)
+    batch_groups = {}  # (pid, index) -> groups an earlier image of the list is sent to
+    for i in indexes:
+        h = hashes.get(i)
+        if h is None:
+            unique.append(i)
+            continue
+        pid = i.getParent().getPid()
+        earlier = batch.find_all(h, lambda tag: tag[0] == pid)
+        found = matches.get(i, []) + earlier
+        received = set()
+        for c in matches.get(i, []):
+            groups = delivered[c[1]]
+            received.update(groups if len(groups) > 0 else targets[i])
+        for c in earlier:
+            received.update(batch_groups[c[1]])
+        left = [g for g in targets[i] if g not in received]
+        if len(left) < len(targets[i]):
+            match = min(found, key=lambda c: hamming_distance(h, c[0]))
+            log.debug(f"{pid}_{i.getIndex()} - Near-duplicate of {match[1][0]}_{match[1][1]} "
+                      f"({hamming_distance(h, match[0])} bit(s) apart), left out of "
+                      f"{len(targets[i]) - len(left)} group(s).", pid=pid, index=i.getIndex(), stage="dedup")
+            targets[i] = left
+        if len(left) == 0:
+            duplicates.append(i)
+            continue
+        unique.append(i)
+        batch.add(h, (pid, i.getIndex()))
+        batch_groups[(pid, i.getIndex())] = left
+    metrics.items.inc("duplicate", amount=len(duplicates))
+    return unique, duplicates
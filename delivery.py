@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from mirai_core import Bot
+from mirai_core.models.Message import Image, Plain
+from mirai_core.models.Types import MessageType
+import config as _config
+import imgcache
+import log
+import metrics
+import scheduler
+
+
+class DeliveryResult:
+    _index: object  # picdb.ImageRecordIndex
+    _image_id: str
+    _sent_groups: list
+    _failed_groups: list
+
+    def __init__(self, index):
+        self._index = index
+        self._image_id = None
+        self._sent_groups = []
+        self._failed_groups = []
+
+    def getIndex(self):
+        return self._index
+
+    def getImageId(self) -> str:
+        return self._image_id
+
+    def getSentGroups(self) -> list:
+        return self._sent_groups
+
+    def getFailedGroups(self) -> list:
+        return self._failed_groups
+
+    def isSent(self) -> bool:
+        """True once every group it was sent to has received it."""
+        return (len(self._sent_groups) > 0) & (len(self._failed_groups) == 0)
+
+
+def _build_message(index, image_id: str) -> list:
+    rec = index.getParent()
+    n = len(rec.getRecordIndex())
+    text = rec.getOriginUrl()
+    if n > 1:
+        text += f" ({index.getIndex() + 1}/{n})"
+    return [Plain(text + "\n"), Image(imageId=image_id)]
+
+
+async def _upload(bot: Bot, res: DeliveryResult, limit: asyncio.Semaphore, path: str) -> str:
+    idx = res.getIndex()
+    name = f"{idx.getParent().getPid()}_{idx.getIndex()}"
+    async with limit:
+        st = time.monotonic()
+        try:
+            img = await bot.upload_image(MessageType.GROUP, path)
+            res._image_id = img.imageId
+            metrics.delivery_upload_seconds.observe(time.monotonic() - st)
+            log.debug(f"{name} - Uploaded as {img.imageId} in {time.monotonic() - st:.2f}s", pid=idx.getParent().getPid(),
+                      index=idx.getIndex(), stage="upload", duration=round(time.monotonic() - st, 3))
+        except Exception as e:
+            log.failed(f"{name} - Failed to upload image: {e}", pid=idx.getParent().getPid(), index=idx.getIndex(),
+                       stage="upload")
+            # A retry would fail the same way if the file has gone, make it download the file again.
+            await scheduler.run_blocking(imgcache.discard_missing, os.path.basename(path))
+    return res._image_id
+
+
+async def _send_to_group(bot: Bot, group: int, results: list, uploads: list, limit: asyncio.Semaphore,
+                         targets: dict):
+    async with limit:
+        for res, upload in zip(results, uploads):
+            idx = res.getIndex()
+            if (targets is not None) and (group not in targets.get(idx, ())):
+                continue  # Filtered out by rules of this group
+            image_id = await upload  # Shared by every group, only uploaded once.
+            if image_id is None:
+                res._failed_groups.append(group)
+                metrics.delivery_messages.inc("failed")
+                continue
+            try:
+                await bot.send_message(group, MessageType.GROUP, _build_message(idx, image_id))
+                res._sent_groups.append(group)
+                metrics.delivery_messages.inc("sent")
+            except Exception as e:
+                res._failed_groups.append(group)
+                metrics.delivery_messages.inc("failed")
+                log.failed(f"{idx.getParent().getPid()}_{idx.getIndex()} - Failed to send to group {group}: {e}",
+                           pid=idx.getParent().getPid(), index=idx.getIndex(), stage="send", group=group)
+
+
+async def deliver_images(bot: Bot, conf: _config.BotConf, indexes: list, groups: list = None,
+                         paths: dict = None, targets: dict = None) -> list:
+    """
+    Upload each cached image once and send it to every response group. Groups are served concurrently (at most
+    delivery_group_concurrency at once) while each group receives images in the given order.
+    paths may map an index to the file which should be uploaded instead of its cached original, and targets may
+    map an index to the groups which should receive it.
+    Returns DeliveryResult for each given index.
+    """
+    if groups is None:
+        groups = conf.response_group
+    results = [DeliveryResult(i) for i in indexes]
+    if (len(results) == 0) | (len(groups) == 0):
+        return results
+
+    loop = asyncio.get_running_loop()
+    upload_limit = asyncio.Semaphore(max(1, conf.delivery_upload_concurrency))
+    group_limit = asyncio.Semaphore(max(1, conf.delivery_group_concurrency))
+    if paths is None:
+        paths = {}
+    uploads = []
+    for r in results:
+        if (targets is not None) and (len(targets.get(r.getIndex(), ())) == 0):
+            uploads.append(None)  # No group would receive it
+            continue
+        path = paths.get(r.getIndex()) or r.getIndex().getCacheLocalFilePath()
+        uploads.append(loop.create_task(_upload(bot, r, upload_limit, path)))
+    try:
+        await asyncio.gather(*[_send_to_group(bot, g, results, uploads, group_limit, targets) for g in groups])
+    finally:
+        for u in uploads:
+            if u is not None:
+                u.cancel()
+
+    sent = sum(1 for r in results if r.isSent())
+    metrics.items.inc("sent", amount=sent)
+    log.success(f"Delivered {sent} of {len(results)} image(s) to {len(groups)} group(s).")
+    return results
@@ -0,0 +1,137 @@
+import fnmatch
+import re
+import weakref
+import config as _config
+
+# Filter keys which can be overridden per response group in 'response_group_filter'.
+_filter_keys = _config.filter_keys
+
+# show_policy_limited_image -> allowed pic_policy_type values
+_policy_table = {
+    0: frozenset((0,)),
+    1: frozenset((0, 1)),
+    2: frozenset((0, 2)),
+    3: frozenset((0, 1, 2)),
+}
+
+_compiled = weakref.WeakKeyDictionary()  # BotConf -> FilterSet
+
+
+class CompiledFilter:
+    """
+    One set of filter rules compiled into frozensets and a single regex. Checks run from the cheapest one,
+    and tag check costs O(tags on the illust) whatever the size of configured tag list is.
+    """
+    _policies: frozenset
+    _pids: frozenset
+    _pid_whitelist: bool
+    _uids: frozenset
+    _uid_whitelist: bool
+    _tags: frozenset
+    _tag_pattern: re.Pattern
+    _tag_whitelist: bool
+
+    def __init__(self, rules: dict):
+        policy = rules["show_policy_limited_image"]
+        if policy not in _policy_table:
+            raise ValueError(f"'show_policy_limited_image' should be one of {list(_policy_table.keys())}.")
+        self._policies = _policy_table[policy]
+        self._pids = frozenset(str(p) for p in rules["image_pid_filter"])
+        self._pid_whitelist = rules["image_pid_filter_as_whitelist"]
+        self._uids = frozenset(str(u) for u in rules["image_uid_filter"])
+        self._uid_whitelist = rules["image_uid_filter_as_whitelist"]
+        self._tag_whitelist = rules["image_tag_filter_as_whitelist"]
+
+        # Plain tags are matched by set lookup, 're:' prefixed ones are regex and ones with '*?[' are wildcards.
+        tags = []
+        patterns = []
+        for t in rules["image_tag_filter"]:
+            t = str(t)
+            if t.startswith("re:"):
+                patterns.append(f"(?:{t[3:]})")
+            elif any(c in t for c in "*?["):
+                patterns.append(f"(?:{fnmatch.translate(t)})")
+            else:
+                tags.append(t)
+        self._tags = frozenset(tags)
+        self._tag_pattern = re.compile("|".join(patterns)) if len(patterns) > 0 else None
+
+    def validPolicy(self, record) -> bool:
+        p = record.getPolicy()
+        return getattr(p, "value", p) in self._policies
+
+    def validPid(self, record) -> bool:
+        return (record.getPid() in self._pids) == self._pid_whitelist
+
+    def validUid(self, record) -> bool:
+        return (record.getUid() in self._uids) == self._uid_whitelist
+
+    def validTag(self, record) -> bool:
+        include = False
+        for t in record.getTags():
+            if (t in self._tags) or ((self._tag_pattern is not None) and (self._tag_pattern.fullmatch(t) is not None)):
+                include = True
+                break
+        return include == self._tag_whitelist
+
+    def accept(self, record) -> bool:
+        return self.validPolicy(record) and self.validPid(record) and self.validUid(record) \
+            and self.validTag(record)
+
+    def evaluate(self, records: list) -> list:
+        """Evaluate a batch of ImageRecord, returns list of bool in the same order. None is never accepted."""
+        accept = self.accept
+        return [(r is not None) and accept(r) for r in records]
+
+
+class FilterSet:
+    """Default rules from config and per response group overrides, compiled once per BotConf."""
+    _default: CompiledFilter
+    _groups: dict  # group -> CompiledFilter
+
+    def __init__(self, conf: _config.BotConf, groups: list = None):
+        base = {k: getattr(conf, k) for k in _filter_keys}
+        self._default = CompiledFilter(base)
+        self._groups = {}
+        if groups is None:
+            groups = conf.response_group
+        overrides = conf.response_group_filter or {}
+        for g, o in overrides.items():
+            if not isinstance(o, dict):
+                raise TypeError(f"'response_group_filter' of group {g} should be {str(dict)}.")
+            unknown = set(o.keys()) - set(_filter_keys)
+            if len(unknown) > 0:
+                raise AttributeError(f"Unknown filter key {sorted(unknown)} in 'response_group_filter' of group {g}.")
+            rules = dict(base)
+            rules.update(o)
+            self._groups[int(g)] = CompiledFilter(rules)
+        self._targets = [int(g) for g in groups]
+
+    def getDefault(self) -> CompiledFilter:
+        return self._default
+
+    def getForGroup(self, group: int) -> CompiledFilter:
+        return self._groups.get(int(group), self._default)
+
+    def hasGroupRules(self) -> bool:
+        return len(self._groups) > 0
+
+    def acceptedGroups(self, record) -> list:
+        """Response groups which should receive given record."""
+        if not self.hasGroupRules():
+            return list(self._targets) if self._default.accept(record) else []
+        return [g for g in self._targets if self.getForGroup(g).accept(record)]
+
+    def evaluate(self, records: list) -> list:
+        """Evaluate a batch of ImageRecord, a record is accepted if any response group would receive it."""
+        if not self.hasGroupRules():
+            return self._default.evaluate(records)
+        return [(r is not None) and (len(self.acceptedGroups(r)) > 0) for r in records]
+
+
+def get_filter_set(conf: _config.BotConf) -> FilterSet:
+    fs = _compiled.get(conf)
+    if fs is None:
+        fs = FilterSet(conf)
+        _compiled[conf] = fs
+    return fs
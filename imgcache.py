@@ -0,0 +1,248 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import config as _config
+import log
+import metrics
+import picdb
+
+_entries: OrderedDict = OrderedDict()  # file_name -> CacheEntry, least recently used first
+_total_size: int = 0
+_budget: int = 0  # Bytes, 0 means unlimited
+_lock = threading.RLock()
+_part_max_age = 7 * 86400  # Seconds an unfinished download is kept for resuming
+_reconcile_batch = 200  # Cache entries written per transaction while reconciling
+
+
+class CacheEntry:
+    _file_name: str
+    _pid: str
+    _index: int
+    _size: int
+    _last_access: float
+    _checksum: str
+
+    def getFileName(self) -> str:
+        return self._file_name
+
+    def getPath(self) -> str:
+        return _config.cache_path + f"/{self._file_name}"
+
+    def getPid(self) -> str:
+        return self._pid
+
+    def getIndex(self) -> int:
+        return self._index
+
+    def getSize(self) -> int:
+        return self._size
+
+    def getLastAccess(self) -> float:
+        return self._last_access
+
+    def getChecksum(self) -> str:
+        return self._checksum
+
+
+def _is_cache_file(name: str) -> bool:
+    # Login info is kept in cache folder as well, it must never be indexed or evicted.
+    return not (name.startswith("login_info_") | name.startswith(".") | name.endswith(".part"))
+
+
+def file_checksum(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_entry(e: CacheEntry):
+    picdb.get_connection().execute("insert or replace into cache_entry values (?,?,?,?,?,?)",
+                                   (e._file_name, e._pid, e._index, e._size, e._last_access, e._checksum))
+
+
+def _delete_entry(file_name: str):
+    picdb.get_connection().execute("delete from cache_entry where file_name=?", (file_name,))
+
+
+def load_cache(conf: _config.BotConf):
+    """
+    Load cache index and reconcile it with files in cache folder. Files are scanned and hashed outside of any
+    transaction and entries are written _reconcile_batch at a time, so reconciling a large cache never holds the
+    write lock of a database shared with other instances for long.
+    """
+    global _entries, _total_size, _budget
+
+    entries = OrderedDict()
+    for r in picdb.get_connection().execute("select file_name, pix_image_id, pix_image_index, size, last_access, "
+                                            "checksum from cache_entry order by last_access").fetchall():
+        e = CacheEntry()
+        e._file_name, e._pid, e._index, e._size, e._last_access, e._checksum = r
+        entries[e._file_name] = e
+
+    # Reconcile with files on disk
+    on_disk = {}
+    stale = 0
+    for d in os.scandir(_config.cache_path):
+        if d.is_file() & _is_cache_file(d.name):
+            on_disk[d.name] = d.stat().st_size
+        elif d.is_file() and d.name.endswith(".part") and (time.time() - d.stat().st_mtime > _part_max_age):
+            os.remove(d.path)
+            stale += 1
+
+    # Missing or modified outside, file will be re-indexed if it exists.
+    dropped = [name for name in entries.keys() if on_disk.get(name) != entries[name]._size]
+    for name in dropped:
+        del entries[name]
+
+    adopted = []
+    for name, size in on_disk.items():
+        if name in entries:
+            continue
+        p = _config.cache_path + f"/{name}"
+        e = CacheEntry()
+        e._file_name = name
+        e._pid, e._index = _parse_file_name(name)
+        e._size = size
+        e._last_access = os.path.getmtime(p)
+        e._checksum = file_checksum(p)
+        entries[name] = e
+        adopted.append(e)
+    if len(adopted) > 0:
+        entries = OrderedDict(sorted(entries.items(), key=lambda kv: kv[1]._last_access))
+
+    for n in range(0, len(dropped), _reconcile_batch):
+        with picdb.transaction():
+            for name in dropped[n:n + _reconcile_batch]:
+                _delete_entry(name)
+    for n in range(0, len(adopted), _reconcile_batch):
+        with picdb.transaction():
+            for e in adopted[n:n + _reconcile_batch]:
+                _write_entry(e)
+
+    with picdb.transaction(), _lock:
+        _budget = max(0, conf.cache_size_limit_mb) * 1024 * 1024
+        _entries = entries
+        _total_size = sum(e._size for e in _entries.values())
+        evicted = _evict()
+    log.debug(f"Image cache: {len(_entries)} file(s), {_total_size} bytes. "
+              f"Dropped {len(dropped)}, adopted {len(adopted)}, evicted {evicted}, removed {stale} stale part(s) "
+              f"while reconciling.")
+
+
+def _parse_file_name(name: str) -> tuple:
+    # Pixiv originals are named like '12345678_p0.png'
+    stem = name.split(".")[0]
+    if "_p" in stem:
+        pid, _, idx = stem.partition("_p")
+        if pid.isdigit() & idx.isdigit():
+            return pid, int(idx)
+    return None, None
+
+
+def _evict() -> int:
+    """Remove least recently used files until cache fits into budget. Lock must be held."""
+    global _total_size
+    if _budget <= 0:
+        return 0
+    count = 0
+    while (_total_size > _budget) & (len(_entries) > 1):
+        name, e = _entries.popitem(last=False)
+        _total_size -= e._size
+        try:
+            os.remove(e.getPath())
+        except FileNotFoundError:
+            pass
+        _delete_entry(name)
+        count += 1
+        log.debug(f"Image cache evicted '{name}' ({e._size} bytes).")
+    return count
+
+
+def has(file_name: str, count: bool = False) -> bool:
+    """Whether file is cached. Only lookups made with count, the ones deciding to download, go into hit ratio."""
+    with _lock:
+        hit = file_name in _entries
+    if count:
+        metrics.cache_lookups.inc("hit" if hit else "miss")
+    return hit
+
+
+def get(file_name: str) -> CacheEntry:
+    with _lock:
+        return _entries.get(file_name)
+
+
+def touch(file_name: str) -> bool:
+    """Mark a cached file as recently used."""
+    with picdb.transaction(), _lock:
+        e = _entries.get(file_name)
+        if e is None:
+            return False
+        e._last_access = time.time()
+        _entries.move_to_end(file_name)
+        picdb.get_connection().execute("update cache_entry set last_access=? where file_name=?",
+                                       (e._last_access, file_name))
+        return True
+
+
+def put(file_name: str, pid: str, index: int, size: int, checksum: str) -> CacheEntry:
+    """Index a file which has been written into cache folder, and evict old ones if budget is exceeded."""
+    global _total_size
+    with picdb.transaction(), _lock:
+        old = _entries.pop(file_name, None)
+        if old is not None:
+            _total_size -= old._size
+        e = CacheEntry()
+        e._file_name = file_name
+        e._pid = pid
+        e._index = index
+        e._size = size
+        e._last_access = time.time()
+        e._checksum = checksum
+        _entries[file_name] = e
+        _total_size += size
+        _write_entry(e)
+        _evict()
+        return e
+
+
+def remove(file_name: str):
+    global _total_size
+    with picdb.transaction(), _lock:
+        e = _entries.pop(file_name, None)
+        if e is None:
+            return
+        _total_size -= e._size
+        try:
+            os.remove(e.getPath())
+        except FileNotFoundError:
+            pass
+        _delete_entry(file_name)
+
+
+def discard_missing(file_name: str) -> bool:
+    """
+    Drop entry of a file which has gone from cache folder, deleted by hand or evicted by another instance sharing
+    it, so the next lookup misses and downloads it again. Returns True if the file was missing.
+    """
+    e = get(file_name)
+    if (e is None) or os.path.exists(e.getPath()):
+        return False
+    log.warn(f"Cached file '{file_name}' has gone, it will be downloaded again.")
+    remove(file_name)
+    return True
+
+
+def get_total_size() -> int:
+    return _total_size
+
+
+def get_budget() -> int:
+    return _budget
+
+
+_size_gauge = metrics.Gauge("imgcache_bytes", "Bytes of files in image cache.", func=get_total_size)
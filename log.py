@@ -1,53 +1,257 @@
 from datetime import datetime
+import atexit
+import json
+import os
+import queue
 import sys
+import threading
+import time
 import traceback
 
-print_debug = True
+# Records are put into a queue by the calling thread and written by a background writer, so a slow or piped
+# stdout never stalls the caller. Level check is the only work done before enqueueing.
 
+_levels = {"debug": 10, "process": 20, "success": 20, "warn": 30, "failed": 40}
+_level_names = {"debug": 10, "info": 20, "warn": 30, "warning": 30, "error": 40, "failed": 40}
+_prefixes = {
+    "debug": "💡 Debug",
+    "process": "⏳ Process",
+    "success": "✅ Success",
+    "warn": "⚠️ Warning",
+    "failed": "❌ Failed",
+}
+_max_pending = 10000  # Records below warn level are dropped while this many are waiting
 
-def _ptprint(msg: str):
-    n = datetime.now()
-    t = n.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{t}] " + msg)
+_level = 10
+_format = "text"  # text or json
+_console = True
+_stream = None  # Console stream, sys.stdout at writing time if None
+_file_path: str = None
+_file_max_bytes = 10 * 1024 * 1024
+_file_backups = 3
 
+_queue = queue.SimpleQueue()
+_pending = 0  # Approximate, only used for dropping
+_dropped = 0
+_writer: threading.Thread = None
+_writer_lock = threading.Lock()
+_file = None
 
-def success(text: str = None):
-    if text is None:
-        _ptprint("✅ Success")
-    else:
-        _ptprint("✅ Success: " + text)
 
+class _Flush:
+    def __init__(self):
+        self.done = threading.Event()
 
-def process(text: str = None):
-    if text is None:
-        _ptprint("⏳ Process")
-    else:
-        _ptprint("⏳ Process: " + text)
 
+def _ensure_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name="log-writer", daemon=True)
+            _writer.start()
 
-def warn(text: str = None):
-    if text is None:
-        _ptprint("⚠️ Warning")
-    else:
-        _ptprint("⚠️ Warning: " + text)
+
+def _emit(level: str, text: str, fields: dict):
+    global _pending, _dropped
+    if _levels[level] < _level:
+        return
+    if (_pending >= _max_pending) and (_levels[level] < _levels["warn"]):
+        _dropped += 1
+        return
+    _pending += 1
+    _queue.put((time.time(), level, text, fields, threading.current_thread().name))
+    _ensure_writer()
+
+
+def _format_record(record: tuple) -> str:
+    created, level, text, fields, thread = record
+    if _format == "json":
+        body = {"time": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"), "level": level,
+                "message": text, "thread": thread}
+        if fields:
+            body.update(fields)
+        return json.dumps(body, ensure_ascii=False, default=str)
+
+    t = datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S")
+    if level == "trace":
+        return text.rstrip("\n")
+    msg = _prefixes[level] if text is None else f"{_prefixes[level]}: {text}"
+    if fields:
+        msg += " | " + " ".join(f"{k}={v}" for k, v in fields.items())
+    return f"[{t}] {msg}"
 
 
-def failed(text: str = None):
-    if text is None:
-        _ptprint("❌ Failed")
+def _open_file():
+    global _file
+    if (_file is None) and (_file_path is not None):
+        d = os.path.dirname(_file_path)
+        if d != "":
+            os.makedirs(d, exist_ok=True)
+        _file = open(_file_path, "a", encoding="utf-8")
+
+
+def _rotate():
+    global _file
+    _file.close()
+    _file = None
+    for i in range(_file_backups - 1, 0, -1):
+        src = f"{_file_path}.{i}"
+        if os.path.exists(src):
+            os.replace(src, f"{_file_path}.{i + 1}")
+    if _file_backups > 0:
+        os.replace(_file_path, f"{_file_path}.1")
     else:
-        _ptprint("❌ Failed: " + text)
+        os.remove(_file_path)
+    _open_file()
+
+
+def _write(lines: list, errors: list):
+    if _console:
+        out = _stream if _stream is not None else sys.stdout
+        try:
+            if len(lines) > 0:
+                out.write("\n".join(lines) + "\n")
+            if len(errors) > 0:
+                err = _stream if _stream is not None else sys.stderr
+                err.write("\n".join(errors) + "\n")
+            out.flush()
+        except (OSError, ValueError):
+            pass  # Console went away, file still gets records
+    if _file_path is not None:
+        try:
+            _open_file()
+            _file.write("\n".join(lines + errors) + "\n")
+            _file.flush()
+            if _file.tell() >= _file_max_bytes:
+                _rotate()
+        except OSError as e:
+            sys.stderr.write(f"Failed to write log file '{_file_path}': {e}\n")
+
+
+def _write_loop():
+    global _pending, _dropped
+    while True:
+        batch = [_queue.get()]
+        while True:  # Drain what is waiting, written with one flush
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        lines = []
+        errors = []
+        flushes = []
+        for r in batch:
+            if isinstance(r, _Flush):
+                flushes.append(r)
+                continue
+            _pending -= 1
+            try:
+                (errors if r[1] == "trace" else lines).append(_format_record(r))
+            except Exception as e:
+                lines.append(f"Failed to format log record: {e}")
+        if _dropped > 0:
+            n = _dropped
+            _dropped = 0
+            lines.append(_format_record((time.time(), "warn", f"{n} log record(s) dropped, writer fell behind.",
+                                         None, "log-writer")))
+        if (len(lines) > 0) or (len(errors) > 0):
+            _write(lines, errors)
+        for f in flushes:
+            f.done.set()
+
+
+def flush(timeout: float = 5) -> bool:
+    """Wait until every record logged before this call has been written."""
+    if _writer is None:
+        return True
+    f = _Flush()
+    _queue.put(f)
+    return f.done.wait(timeout)
+
 
+def set_level(level: str):
+    global _level
+    if level.lower() not in _level_names:
+        raise ValueError(f"Unknown log level '{level}', should be one of {list(_level_names.keys())}.")
+    _level = _level_names[level.lower()]
 
-def debug(text: str = None):
-    if not print_debug:
+
+def is_enabled_for(level: str) -> bool:
+    return _levels[level] >= _level
+
+
+def configure(level: str = None, format: str = None, console: bool = None, stream=None, file: str = None,
+              file_max_kb: int = None, file_backups: int = None):
+    """Change logging backend. Arguments left as None are not changed."""
+    global _format, _console, _stream, _file_path, _file_max_bytes, _file_backups, _file
+    flush()
+    if level is not None:
+        set_level(level)
+    if format is not None:
+        if format not in ("text", "json"):
+            raise ValueError("Log format should be 'text' or 'json'.")
+        _format = format
+    if console is not None:
+        _console = console
+    if stream is not None:
+        _stream = stream
+    if file_max_kb is not None:
+        _file_max_bytes = max(1, file_max_kb) * 1024
+    if file_backups is not None:
+        _file_backups = max(0, file_backups)
+    if (file is not None) and (file != _file_path):
+        if _file is not None:
+            _file.close()
+            _file = None
+        _file_path = file if file != "" else None
+
+
+def apply_config(conf):
+    """Configure from log_* keys of BotConf."""
+    configure(level=conf.log_level, format=conf.log_format, console=conf.log_console, file=conf.log_file or "",
+              file_max_kb=conf.log_file_max_kb, file_backups=conf.log_file_backups)
+
+
+def shutdown():
+    global _file
+    flush()
+    if _file is not None:
+        _file.close()
+        _file = None
+
+
+atexit.register(shutdown)
+
+
+def success(text: str = None, **fields):
+    _emit("success", text, fields)
+
+
+def process(text: str = None, **fields):
+    _emit("process", text, fields)
+
+
+def warn(text: str = None, **fields):
+    _emit("warn", text, fields)
+
+
+def failed(text: str = None, **fields):
+    _emit("failed", text, fields)
+
+
+def debug(text: str = None, **fields):
+    if _level > 10:
         return
-    if text is None:
-        _ptprint("💡 Debug")
-    else:
-        _ptprint("💡 Debug: " + text)
+    _emit("debug", text, fields)
 
 
 def print_recent_err():
+    global _pending
     et, ev, tb = sys.exc_info()
-    traceback.print_exception(et, ev, tb)
+    text = "".join(traceback.format_exception(et, ev, tb))  # Must be formatted on the thread which caught it
+    _pending += 1
+    _queue.put((time.time(), "trace", text, None, threading.current_thread().name))
+    _ensure_writer()
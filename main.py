@@ -1,68 +1,224 @@
-import threading
+import time
+_started = time.monotonic()  # Taken before other imports, so time to first poll includes them
+
+import asyncio
+import functools
+import signal
+from concurrent.futures import ThreadPoolExecutor
 
 import config
+import dedup
+import delivery
+import image_filter
+import imgcache
 from mirai_core import Bot, Updater
 from mirai_core.models import Event, Message, Types
 import pixiv_action
+import pixiv_download
 import pixiv_oauth as oauth
+import prefetch
+import ratelimit
 from picdb import *
 from pixivpy3 import *
-from gppt import LoginInfo
 import log
-import schedule
-import time
+import metrics
+import scheduler
+import transcode
 
 _app: AppPixivAPI
 _updater: Updater
 _bot: Bot
 _conf: config.BotConf
+_watchers: list = []  # BotConf of each watcher
+_loop: asyncio.AbstractEventLoop = None
+_scheduler = scheduler.Scheduler()
 _exit = False
 _return_val = 0
-
-
-def send_image():
-    list = pixiv_action.fetch_bookmarks(_app, _conf, _conf.check_bookmark_new_sending_limit)
-    l = "Sending List:"
+_first_poll_done = False
+
+
+def _job_name(conf: config.BotConf) -> str:
+    return "send_image" if conf.watcher_name == "" else f"send_image:{conf.watcher_name}"
+
+
+async def _keep_lease(job_name: str, lost: asyncio.Event):
+    """Heartbeat of a lease until cancelled, lost is set once another instance has taken it over."""
+    while True:
+        await asyncio.sleep(_conf.lease_ttl / 3)
+        try:
+            if not await scheduler.run_blocking(renew_lease, job_name, get_instance_id(), _conf.lease_ttl):
+                log.failed(f"Lease of job '{job_name}' was taken over by another instance.")
+                lost.set()
+                return
+        except Exception as e:
+            log.warn(f"Failed to renew lease of job '{job_name}': {e}")
+
+
+async def send_image(conf: config.BotConf = None):
+    """
+    One cycle of a watcher. Every watcher shares app, database, image cache and rate limiter. Instances sharing
+    the database take turns through the lease of the job, the holder reloads history of others before polling.
+    Blocking steps go through scheduler.run_blocking(), so the lease is only released once none of them runs.
+    """
+    if conf is None:
+        conf = _conf
+    job_name = _job_name(conf)
+    if not await scheduler.run_blocking(try_acquire_lease, job_name, get_instance_id(), conf.lease_ttl):
+        log.debug(f"Job '{job_name}' is leased by another instance, skip this cycle.")
+        return
+    lost = asyncio.Event()
+    heartbeat = asyncio.get_running_loop().create_task(_keep_lease(job_name, lost))
+    try:
+        n = await scheduler.run_blocking(refresh_sent_set)
+        if n > 0:
+            log.debug(f"Loaded {n} image(s) sent by other instances.")
+        await scheduler.run_blocking(dedup.refresh, conf)
+        await _send_cycle(conf, lost)
+        if not lost.is_set():
+            await scheduler.run_blocking(prefetch.prefetch_pending, _app, conf)
+    finally:
+        heartbeat.cancel()
+        await scheduler.run_blocking(release_lease, job_name, get_instance_id())
+
+
+async def _send_cycle(conf: config.BotConf, lost: asyncio.Event):
+    """Queue new bookmarks into outbox, then send at most check_bookmark_new_sending_limit due items of it."""
+    scope = conf.watcher_name
+    n = await scheduler.run_blocking(recover_outbox, conf, scope)
+    if n > 0:
+        log.warn(f"Resume {n} image(s) left unfinished by previous run, they may be sent twice.")
+    await scheduler.run_blocking(pixiv_action.poll_bookmarks, _app, conf)
+    if not _first_poll_done:
+        _report_first_poll()
+    list = await scheduler.run_blocking(claim_outbox, scope, conf.check_bookmark_new_sending_limit)
+    if len(list) == 0:
+        return
+    l = "Sending List:" if conf.watcher_name == "" else f"Sending List of '{conf.watcher_name}':"
     for i in list:
         l += f"\n{i.getParent().getPid()}[{i.getIndex()}]"
     log.debug(l)
-    pass
+
+    filters = image_filter.get_filter_set(conf)
+    targets = {i: filters.acceptedGroups(i.getParent()) for i in list}
+    nobody = [i for i in list if len(targets[i]) == 0]
+    if len(nobody) > 0:
+        await scheduler.run_blocking(discard_outbox, nobody, scope)
+    list = [i for i in list if len(targets[i]) > 0]
+    covered = await scheduler.run_blocking(_delivered_groups, conf, list)
+    for i in list:
+        targets[i] = [g for g in targets[i] if g not in covered[i]]
+    done = [i for i in list if len(targets[i]) == 0]
+    if len(done) > 0:
+        log.debug(f"{len(done)} image(s) have been sent to every group already.")
+        await scheduler.run_blocking(complete_outbox, history_action_type.bookmark_modification_post, done, scope)
+    list = [i for i in list if len(targets[i]) > 0]
+    if len(list) == 0:
+        return
+
+    caches = await scheduler.run_blocking(create_caches, _app, conf, list)
+    for c in caches:
+        if not c.isSuccess():
+            await scheduler.run_blocking(functools.partial(retry_outbox, conf, [c.getIndex()], c.getError(),
+                                                           scope, permanent=(c.getError() == "non-public")))
+    cached = [c.getIndex() for c in caches if c.isSuccess()]
+    if dedup.is_enabled(conf):
+        hashes = await dedup.hash_cached(conf, cached)
+        cached, duplicates = await scheduler.run_blocking(dedup.filter_duplicates, conf, cached, hashes, targets,
+                                                          scope)
+        if len(duplicates) > 0:
+            await scheduler.run_blocking(discard_outbox, duplicates, scope)
+    if len(cached) == 0:
+        return
+    await scheduler.run_blocking(set_outbox_state, cached, outbox_state.uploading, scope)
+    paths = await transcode.prepare_uploads(conf, cached)
+    if lost.is_set():
+        log.failed(f"Lease of job '{_job_name(conf)}' is lost, abort before sending.")
+        return  # Left as uploading, holder of the lease puts them back to pending.
+    results = await delivery.deliver_images(_bot, conf, cached, paths=paths, targets=targets)
+    # Recorded before anything else, so groups which have received an image are left out of any retry.
+    delivered = {r.getIndex(): r.getSentGroups() for r in results if len(r.getSentGroups()) > 0}
+    if len(delivered) > 0:
+        await scheduler.run_blocking(write_deliveries, delivered, scope)
+    sent = [r.getIndex() for r in results if r.isSent()]
+    if len(sent) > 0:
+        await scheduler.run_blocking(complete_outbox, history_action_type.bookmark_modification_post, sent, scope)
+    for r in results:
+        if not r.isSent():
+            failed = ", ".join(str(g) for g in r.getFailedGroups())
+            error = f"failed to send to group(s) {failed}" if failed != "" else "failed to send to any group"
+            await scheduler.run_blocking(retry_outbox, conf, [r.getIndex()], error, scope)
+
+
+def _delivered_groups(conf: config.BotConf, indexes: list) -> dict:
+    """
+    Groups which have received each ImageRecordIndex already: those recorded by any watcher (including earlier
+    attempts of this one), and those accepted by filters of another watcher which has it in history. History is
+    only written once every group of the watcher has received it, and outlives delivery records after rollup.
+    An illust bookmarked by several watched users is sent to a group they share only once.
+    """
+    pairs = [(i.getParent().getPid(), i.getIndex()) for i in indexes]
+    delivered = query_delivered_groups(pairs)
+    result = {i: set(delivered[p]) for i, p in zip(indexes, pairs)}
+    for w in _watchers:
+        if w.watcher_name == conf.watcher_name:
+            continue
+        sent = query_sent_pairs(pairs, w.watcher_name)
+        if len(sent) == 0:
+            continue
+        filters = image_filter.get_filter_set(w)
+        for i in indexes:
+            if (i.getParent().getPid(), i.getIndex()) in sent:
+                result[i].update(filters.acceptedGroups(i.getParent()))
+    return result
+
+
+def _report_first_poll():
+    global _first_poll_done
+    _first_poll_done = True
+    t = time.monotonic() - _started
+    metrics.first_poll_seconds.set(t)
+    log.success(f"First poll finished {t:.2f}s after start.", duration=round(t, 3))
+
+
+def purge_expired_illusts():
+    n = purge_illust_cache(_conf.illust_cache_ttl)
+    if n > 0:
+        log.debug(f"Purged {n} expired illust(s) from cache.")
+
+
+def roll_up_history():
+    # Any instance may do it, the lease only keeps them from doing it at the same time.
+    if not try_acquire_lease("compact_history", get_instance_id(), _conf.lease_ttl):
+        return
+    try:
+        n = compact_history(_conf)
+        pages = incremental_vacuum()
+        if (n > 0) or (pages > 0):
+            log.debug(f"Rolled up {n} history action(s), gave back {pages} page(s) of database.")
+    finally:
+        release_lease("compact_history", get_instance_id())
 
 
 def _create_app() -> AppPixivAPI:
-    initapp = AppPixivAPI()
-    res: LoginInfo
-    refresh = True
-
-    # Cache login info if possible
-    res = oauth._fetch_cache(_conf)
-    if res is not None:
-        log.process("Trying to using cached login info...")
-        # Test for connection with environment filling
-        initapp.set_auth(access_token=res["access_token"], refresh_token=res["refresh_token"])
-        if _conf.pixiv_user_watch_uid is None:
-            _conf.pixiv_user_watch_uid = res["user"]["id"]
-        test = initapp.user_detail(_conf.pixiv_user_watch_uid)
-        # Check if require login again
-        refresh = not oauth.validate_response(test, False)
-        if refresh:
-            log.failed("Cache was reject. Require refreshing.")
-        else:
-            global _last_testment
-            import typing
-            from datetime import datetime
-            oauth._last_testment = typing.cast(int, datetime.now().timestamp())
-            log.success("Cache was accept.")
-
-    if refresh:
-        res = oauth._refresh_token(_conf)
-        # Set environments
-        oauth._update_app(initapp, _conf, res)
+    initapp = ratelimit.RateLimitedApp(AppPixivAPI(), _conf)
+
+    # Cached token is trusted until its recorded expiry, no request is made to validate it.
+    if oauth.load_cached_token(initapp, _conf):
+        log.success(f"Cached login info was accepted, expires in {oauth.get_expires_in():.0f}s.")
+    else:
+        # Refresh token of cache is tried first, password login is the last resort.
+        oauth.refresh(initapp, _conf)
 
     return initapp
 
+
+def _load_database():
+    load_db()
+    imgcache.load_cache(_conf)
+
 def _create_mirai_connection() -> Bot:
-    b = Bot(_conf.login_qq, _conf.mirai_host, _conf.mirai_host_port, _conf.mirai_authcation_key, scheme=_conf.mirai_schme)
+    b = Bot(_conf.login_qq, _conf.mirai_host, _conf.mirai_host_port, _conf.mirai_authcation_key, loop=_loop,
+            scheme=_conf.mirai_schme)
     return b
 
 
@@ -74,40 +230,58 @@ def _load_config() -> config.BotConf:
 
     try:
         return config.load_config()
-    except NotImplementedError | TypeError as e:
+    except (NotImplementedError, TypeError) as e:
         log.failed(e)
 
     return None
 
 def _serv_create():
-    schedule.every(_conf.check_bookmark_new).minute.do(send_image)
+    # Watchers are staggered over the shortest interval, so they do not hit Pixiv at the same moment.
+    stagger = min(w.check_bookmark_new for w in _watchers) * 60 / len(_watchers)
+    for n, w in enumerate(_watchers):
+        _scheduler.every(w.check_bookmark_new * 60, functools.partial(send_image, w), name=_job_name(w),
+                         jitter=w.schedule_jitter, timeout=w.schedule_job_timeout, delay=n * stagger)
+    _scheduler.every(3600, purge_expired_illusts, name="purge_illust_cache", delay=60)
+    _scheduler.every(_conf.history_compact_interval * 3600, roll_up_history, name="compact_history",
+                     delay=300)
+
+
+async def _serv_run():
+    # Updater only listens SIGINT/SIGTERM for itself and never stops the loop, take them over.
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            _loop.add_signal_handler(sig, safe_exit, 0)
+        except (NotImplementedError, RuntimeError):
+            pass
+    await _scheduler.run()
+
+
+async def _serv_shutdown():
+    _scheduler.shutdown()
+    await _scheduler.wait_closed(_conf.schedule_job_timeout)
+    transcode.shutdown()
+    pixiv_download.close_session()
+    try:
+        await _bot.release()
+    except Exception as e:
+        log.debug(f"Failed to release Mirai session: {e}")
+    try:
+        # Database is closed once the loop stops, so wait for work still running in threads first.
+        await asyncio.wait_for(_loop.shutdown_default_executor(), _conf.schedule_job_timeout)
+    except asyncio.TimeoutError:
+        log.warn("Blocking work is still running after shutdown timeout.")
+    _loop.stop()
 
 
 def safe_exit(code: int = 0):
-    _updater.raise_shutdown()
+    global _exit, _return_val
+    if _exit:
+        return
     _exit = True
     _return_val = code
-
-class _evt_looper(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-
-    def _event_looper(self):
-        while _return_val == 0 | _exit == False:
-            try:
-                schedule.run_pending()
-            except Exception as e:
-                if isinstance(e, KeyboardInterrupt):
-                    log.debug("Receive process_kill signal (Ctrl + C).")
-                    safe_exit(0)
-                    return
-
-                log.failed(f"Found error while process scheduled events: {e}")
-                log.print_recent_err()
-            time.sleep(_conf.schedule_update_interval)
-
-        def run(self):
-            self._event_looper()
+    log.debug("Shutting down services...")
+    if (_loop is not None) and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(_serv_shutdown(), _loop)
 
 
 if __name__ == '__main__':
@@ -121,33 +295,41 @@ if __name__ == '__main__':
         cnf = _load_config()
         if not isinstance(cnf, config.BotConf):
             log.failed("Please fill config file correctly to run this program!")
-            safe_exit(1)
+            exit(1)
         _conf = cnf
+        log.apply_config(_conf)
         log.success("Config")
-
-        # Create application essential
-        log.process("Load record database")
-        load_db()
-        log.success("Database")
-        log.process("Load pixiv application")
-        _app = _create_app()
-        log.success("Pixiv Application")
-
-        # Connect to Mirai service
-        log.process("Connecting to Mirai service")
-        _bot = _create_mirai_connection()
-        _updater = Updater(_bot)
-        log.success("Mirai")
+        if metrics.start_server(_conf):
+            add_trace_callback(metrics.count_statement)
+
+        # Create application essential. Database and Pixiv login do not depend on each other, so they are prepared
+        # at the same time while Mirai objects are created. Mirai handshake runs in the loop along with first poll.
+        log.process("Load record database and pixiv application")
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as pool:
+            db = pool.submit(_load_database)
+            app = pool.submit(_create_app)
+            _loop = asyncio.new_event_loop()
+            _bot = _create_mirai_connection()
+            _updater = Updater(_bot)
+            db.result()
+            log.success("Database")
+            _app = app.result()
+            log.success("Pixiv Application")
+        log.debug(f"Leases of jobs are taken as '{get_instance_id(_conf)}'.")
+        _watchers = config.build_watchers(_conf)
+        if len(_conf.watchers) > 0:
+            log.debug(f"Watching {len(_watchers)} watcher(s): " +
+                      ", ".join(f"'{w.watcher_name}' ({w.pixiv_user_watch_uid}/{w.check_bookmark_restrict})"
+                                for w in _watchers))
 
         # Hook service
         log.process("Hooking self-managed events")
         _serv_create()
         log.success("Self-managed Events")
 
-        # Start Service Loop
+        # Start Service Loop, scheduler shares the event loop with Mirai updater.
         log.success("Start Bot Service")
-        timer = _evt_looper()
-        timer.start()
+        _loop.create_task(_serv_run())
         _updater.run()
 
     except Exception as e:
@@ -160,6 +342,7 @@ if __name__ == '__main__':
         _return_val = 0
 
     finally:
+        metrics.stop_server()
         clean_up_db()
 
     log.debug("Exiting Program...")
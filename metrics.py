@@ -0,0 +1,276 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config as _config
+import log
+
+# Nothing is recorded until the endpoint has been started, so instrumented code only pays one flag check.
+_enabled = False
+_registry: list = []
+_registry_lock = threading.Lock()
+_server: ThreadingHTTPServer = None
+
+_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_db_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+
+def _format_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+class _Metric:
+    _type = "untyped"
+    _name: str
+    _help: str
+    _labels: tuple
+    _values: dict  # label values -> value
+    _lock: threading.Lock
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self._name = name
+        self._help = help
+        self._labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def getName(self) -> str:
+        return self._name
+
+    def get(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> list:
+        with self._lock:
+            return [(self._name, k, v) for k, v in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self._name} {self._help}", f"# TYPE {self._name} {self._type}"]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{_format_labels(self._labels, labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    _type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge which is set by instrumented code, or read from func at scrape time."""
+    _type = "gauge"
+    _func: object
+
+    def __init__(self, name: str, help: str, labels: tuple = (), func=None):
+        super().__init__(name, help, labels)
+        self._func = func
+
+    def set(self, value: float, *labels):
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self) -> list:
+        if self._func is None:
+            return super()._samples()
+        try:
+            v = self._func()
+        except Exception as e:
+            log.debug(f"Failed to collect metric '{self._name}': {e}")
+            return []
+        if isinstance(v, dict):  # label values -> value
+            return [(self._name, k if isinstance(k, tuple) else (k,), x) for k, x in v.items()]
+        return [(self._name, (), v)]
+
+
+class Histogram(_Metric):
+    _type = "histogram"
+    _buckets: tuple
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = _latency_buckets):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        if not _enabled:
+            return
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = [[0] * (len(self._buckets) + 1), 0.0, 0]  # Per bucket counts, sum, count
+                self._values[labels] = v
+            v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def time(self, *labels) -> "Timer":
+        return Timer(self, labels)
+
+    def get(self, *labels) -> float:
+        v = self._values.get(labels)
+        return 0 if v is None else v[2]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self._name} {self._help}", f"# TYPE {self._name} {self._type}"]
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        for labels, counts, total, count in items:
+            acc = 0
+            for le, c in zip(self._buckets + (float("inf"),), counts):
+                acc += c
+                le = 'le="' + _format_value(le) + '"'
+                lines.append(f"{self._name}_bucket{_format_labels(self._labels, labels, le)} {acc}")
+            lines.append(f"{self._name}_sum{_format_labels(self._labels, labels)} {_format_value(total)}")
+            lines.append(f"{self._name}_count{_format_labels(self._labels, labels)} {count}")
+        return "\n".join(lines)
+
+
+class Timer:
+    """Observe the seconds spent in a with block."""
+    _histogram: Histogram
+    _labels: tuple
+    _start: float
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+
+# Pixiv
+api_requests = Counter("pixiv_api_requests_total", "Requests sent to Pixiv by endpoint.", ("endpoint",))
+api_errors = Counter("pixiv_api_errors_total", "Failed Pixiv requests by endpoint and kind of error.",
+                     ("endpoint", "kind"))
+api_seconds = Histogram("pixiv_api_request_seconds", "Latency of Pixiv requests by endpoint.", ("endpoint",))
+token_refreshes = Counter("pixiv_token_refreshes_total", "Access token refreshes by login method.", ("method",))
+token_refresh_failures = Counter("pixiv_token_refresh_failures_total", "Access token refreshes which failed.")
+
+# Polling
+poll_seconds = Histogram("poll_cycle_seconds", "Duration of walking bookmarks in one cycle by watcher.",
+                         ("watcher",))
+first_poll_seconds = Gauge("poll_first_seconds", "Seconds from process start to the end of the first poll.")
+poll_pages = Counter("poll_pages_total", "Bookmark pages walked.")
+items = Counter("poll_items_total", "Images by stage: found in new bookmarks, filtered out, already sent, queued "
+                                   "into outbox, sent, failed for good.", ("stage",))
+
+# Download and cache
+download_bytes = Counter("download_bytes_total", "Bytes of images downloaded.")
+download_seconds = Histogram("download_seconds", "Time to download one image.")
+download_resumes = Counter("download_resumes_total", "Interrupted downloads continued with a range request.")
+download_failures = Counter("download_failures_total", "Images which failed to download.")
+cache_batch_seconds = Histogram("cache_batch_seconds", "Time to download and index one batch of images.")
+prefetch_bytes = Counter("prefetch_bytes_total", "Bytes of images downloaded ahead of their sending cycle.")
+cache_lookups = Counter("imgcache_lookups_total", "Image cache lookups by result (hit or miss).", ("result",))
+
+# Delivery
+delivery_messages = Counter("delivery_messages_total", "Group messages by result (sent or failed).", ("result",))
+delivery_upload_seconds = Histogram("delivery_upload_seconds", "Time to upload one image to Mirai.")
+
+# Database
+db_statements = Counter("sqlite_statements_total", "SQLite statements executed by keyword.", ("kind",))
+db_transaction_seconds = Histogram("sqlite_transaction_seconds", "Duration of write transactions, "
+                                                                 "including waiting for the write lock.",
+                                   buckets=_db_buckets)
+
+# Scheduler
+scheduler_lag = Histogram("scheduler_lag_seconds", "Delay between due time and start of scheduled jobs.",
+                          ("job",), buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+scheduler_job_seconds = Histogram("scheduler_job_seconds", "Duration of scheduled jobs.", ("job",))
+scheduler_skips = Counter("scheduler_skips_total", "Runs skipped because the previous one was still running.",
+                          ("job",))
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def count_statement(statement: str):
+    """SQLite trace callback."""
+    if not _enabled:
+        return
+    words = statement.split(None, 1)
+    db_statements.inc(words[0].rstrip(";").lower() if len(words) > 0 else "")
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(conf: _config.BotConf) -> bool:
+    """Serve metrics in Prometheus text format on metrics_host:metrics_port. Port 0 disables metrics."""
+    global _enabled, _server
+    if (conf.metrics_port == 0) or (_server is not None):
+        return _server is not None
+    _server = ThreadingHTTPServer((conf.metrics_host, conf.metrics_port), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    _enabled = True
+    log.success(f"Serving metrics at http://{conf.metrics_host}:{conf.metrics_port}/metrics")
+    return True
+
+
+def stop_server():
+    global _enabled, _server
+    _enabled = False
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
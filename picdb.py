@@ -1,24 +1,34 @@
+import hashlib
+import json as _json
+import os
 import os.path
+import socket
 import sqlite3
+import threading
+import time
 import typing
+import zlib
 import pixivpy3
 import config as _config
 import os.path as _path
-from pathlib import Path as _Path
 from sqlite3 import Connection
+from contextlib import contextmanager as _contextmanager
 from enum import Enum as _enum, unique as _unique
 
+import image_filter
+import imgcache
 import log
-import pixiv_oauth
-
-_con: Connection
-_default_db_creation_sql = '''
-DROP TABLE IF EXISTS record;
-DROP TABLE IF EXISTS record_tag;
-DROP TABLE IF EXISTS history;
-DROP TABLE IF EXISTS history_details;
-
-CREATE TABLE record(
+import metrics
+import pixiv_download
+
+_sent: set = set()  # (scope, pid, index) of every image in history_details, older ones are only in sent_rollup
+_sent_action_id = 0  # Newest history action loaded into _sent, history of other instances is read after it
+# Schema migrations, the n-th script upgrades database from user_version n to n+1.
+# Never edit a released script, append a new one instead.
+_migrations = [
+    # 1: Base structure. Databases created before versioning already have some of those tables.
+    '''
+CREATE TABLE IF NOT EXISTS record(
     pix_image_id varchar(10) NOT NULL,
     pix_image_index int NOT NULL,
     pix_creator_id varchar(9) NOT NULL,
@@ -28,25 +38,169 @@ CREATE TABLE record(
     PRIMARY KEY (pix_image_id, pix_image_index)
 );
 
-CREATE TABLE record_tag(
+CREATE TABLE IF NOT EXISTS record_tag(
     pix_image_id varchar(10) NOT NULL,
     tag varchar(40) NOT NULL,
     PRIMARY KEY (pix_image_id, tag),
     FOREIGN KEY(pix_image_id) REFERENCES record(pix_image_id)
 );
 
-CREATE TABLE history(
+CREATE TABLE IF NOT EXISTS history(
     action_id int AUTO_INCREMENT NOT NULL PRIMARY KEY,
     action_type int NOT NULL
 );
 
-CREATE TABLE history_details(
+CREATE TABLE IF NOT EXISTS history_details(
     action_id int NOT NULL,
     pix_image_id varchar(10) NOT NULL,
     pix_image_index int NOT NULL,
     PRIMARY KEY (action_id, pix_image_id, pix_image_index),
     FOREIGN KEY (pix_image_id, pix_image_index) REFERENCES record(pix_image_id, pix_image_index)
 );
+
+CREATE TABLE IF NOT EXISTS state(
+    state_key varchar(100) NOT NULL PRIMARY KEY,
+    state_value text
+);
+
+CREATE TABLE IF NOT EXISTS record_digest(
+    pix_image_id varchar(10) NOT NULL PRIMARY KEY,
+    digest varchar(40) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS cache_entry(
+    file_name varchar(100) NOT NULL PRIMARY KEY,
+    pix_image_id varchar(10),
+    pix_image_index int,
+    size int NOT NULL,
+    last_access real NOT NULL,
+    checksum varchar(40)
+);
+''',
+    # 2: Make history.action_id a real auto-increment key, index history details by image.
+    # history_details is already indexed by action_id through its primary key.
+    '''
+CREATE TABLE history_new(
+    action_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    action_type int NOT NULL
+);
+INSERT INTO history_new(action_id, action_type) SELECT action_id, action_type FROM history;
+DROP TABLE history;
+ALTER TABLE history_new RENAME TO history;
+
+CREATE INDEX IF NOT EXISTS history_details_image ON history_details(pix_image_id, pix_image_index);
+''',
+    # 3: Policy of records is parsed from x_restrict now, force every record to be rewritten once.
+    '''
+DELETE FROM record_digest;
+''',
+    # 4: Cache of illust json, so looking up a known pid does not need a request.
+    '''
+CREATE TABLE IF NOT EXISTS illust_cache(
+    pix_image_id varchar(10) NOT NULL PRIMARY KEY,
+    body blob NOT NULL,
+    digest varchar(40) NOT NULL,
+    version int NOT NULL,
+    fetched_at real NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS illust_cache_fetched_at ON illust_cache(fetched_at);
+''',
+    # 5: History is scoped by watcher, existing history belongs to the default (unnamed) watcher.
+    '''
+ALTER TABLE history ADD COLUMN scope varchar(100) NOT NULL DEFAULT '';
+''',
+    # 6: Leases of jobs, so instances sharing this database never run the same job at once.
+    '''
+CREATE TABLE IF NOT EXISTS job_lease(
+    job_name varchar(100) NOT NULL PRIMARY KEY,
+    owner varchar(100) NOT NULL,
+    acquired_at real NOT NULL,
+    heartbeat_at real NOT NULL,
+    expires_at real NOT NULL
+);
+''',
+    # 7: Outbox of images waiting to be sent, so work found by a cycle survives restarts.
+    '''
+CREATE TABLE IF NOT EXISTS outbox(
+    outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scope varchar(100) NOT NULL,
+    pix_image_id varchar(10) NOT NULL,
+    pix_image_index int NOT NULL,
+    state int NOT NULL DEFAULT 0,
+    attempts int NOT NULL DEFAULT 0,
+    next_retry real NOT NULL DEFAULT 0,
+    enqueued_at real NOT NULL,
+    updated_at real NOT NULL,
+    error text,
+    UNIQUE (scope, pix_image_id, pix_image_index)
+);
+
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox(scope, state, next_retry);
+''',
+    # 8: Perceptual hash (dHash) of images, stored as signed 64 bit integer.
+    '''
+CREATE TABLE IF NOT EXISTS image_phash(
+    pix_image_id varchar(10) NOT NULL,
+    pix_image_index int NOT NULL,
+    phash int NOT NULL,
+    PRIMARY KEY (pix_image_id, pix_image_index)
+);
+''',
+    # 9: Retention. History older than retention is rolled up into a bitmap of sent pages per (scope, pid).
+    # Existing history starts aging from the upgrade.
+    '''
+ALTER TABLE history ADD COLUMN created_at real NOT NULL DEFAULT 0;
+UPDATE history SET created_at=CAST(strftime('%s', 'now') AS real);
+CREATE INDEX IF NOT EXISTS history_created_at ON history(created_at);
+
+CREATE TABLE IF NOT EXISTS sent_rollup(
+    scope varchar(100) NOT NULL,
+    pix_image_id int NOT NULL,
+    word int NOT NULL,
+    bits int NOT NULL,
+    PRIMARY KEY (scope, pix_image_id, word)
+) WITHOUT ROWID;
+''',
+    # 10: Groups each image has been sent to by each watcher, so a partly failed send only retries the rest.
+    '''
+CREATE TABLE IF NOT EXISTS delivery(
+    scope varchar(100) NOT NULL,
+    pix_image_id varchar(10) NOT NULL,
+    pix_image_index int NOT NULL,
+    group_id int NOT NULL,
+    sent_at real NOT NULL,
+    PRIMARY KEY (pix_image_id, pix_image_index, scope, group_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS delivery_sent_at ON delivery(sent_at);
+''',
+    # 11: dHash of sent images whose history has been rolled up, so near-duplicates of them are still found.
+    '''
+CREATE TABLE IF NOT EXISTS sent_phash(
+    scope varchar(100) NOT NULL,
+    pix_image_id varchar(10) NOT NULL,
+    pix_image_index int NOT NULL,
+    phash int NOT NULL,
+    PRIMARY KEY (scope, pix_image_id, pix_image_index)
+) WITHOUT ROWID;
+''',
+]
+
+# Layout version of illust_cache.body, rows of other versions are treated as missing.
+_illust_cache_version = 1
+
+_rollup_word = 63  # Page indexes per word of sent_rollup.bits, keeps it a positive signed 64 bit integer
+_rollup_batch = 500  # History actions rolled up per transaction
+_vacuum_step = 256  # Pages given back per incremental vacuum transaction
+_rebuild_lease_ttl = 3600  # Seconds, a full VACUUM of a large database takes a while
+
+_connection_pragmas = '''
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA cache_size=-16000;
+PRAGMA mmap_size=67108864;
+PRAGMA temp_store=MEMORY;
 '''
 
 
@@ -57,6 +211,15 @@ class history_action_type(_enum):
     bookmark_modification_post = 0
 
 
+@_unique
+class outbox_state(_enum):
+    pending = 0
+    downloading = 1
+    uploading = 2
+    sent = 3
+    failed = 4
+
+
 @_unique
 class pic_policy_type(_enum):
     normal = 0
@@ -72,29 +235,30 @@ class ImageRecord:
     _tags: list
     _policy: pic_policy_type
 
-    def removeDBNonCommit(self):
-        conn = get_connection()
-        conn.execute("delete from record where pix_image_id=?", (self._pid,))
-        conn.execute("delete from record_tag where pix_image_id=?", (self._pid,))
+    def removeDB(self):
+        with transaction() as conn:
+            conn.execute("delete from record where pix_image_id=?", (self._pid,))
+            conn.execute("delete from record_tag where pix_image_id=?", (self._pid,))
+            conn.execute("delete from record_digest where pix_image_id=?", (self._pid,))
 
-    def writeDBNonCommit(self):
-        conn = get_connection()
-        self.removeDBNonCommit(conn)
-        # Perform new updated info
-        for i in self._indexes:
-            if isinstance(i, ImageRecordIndex):
-                conn.execute("insert into record values(?,?,?,?,?,?)",
-                             (self._pid, i._index, self._uid, self._policy, self._url, i._download_url))
+    def writeDB(self):
+        with transaction() as conn:
+            self.removeDB()
+            # Perform new updated info
+            for i in self._indexes:
+                if isinstance(i, ImageRecordIndex):
+                    conn.execute("insert into record values(?,?,?,?,?,?)",
+                                 (self._pid, i._index, self._uid, self._policy.value, self._url, i._download_url))
 
-        for t in self._tags:
-            conn.execute("insert into record_tag values(?,?)", (self._pid, t))
+            for t in self._tags:
+                conn.execute("insert or ignore into record_tag values(?,?)", (self._pid, t))
 
     def isInDBCorrectly(self) -> bool:
         crs = get_connection().cursor()
         crs.execute("select count(*) from record where pix_image_id=?", (self._pid,))
         count = typing.cast(int, crs.fetchone()[0])
         crs.close()
-        return count == len(list)
+        return count == len(self._indexes)
 
     def getPolicy(self) -> pic_policy_type:
         return self._policy
@@ -126,60 +290,54 @@ class ImageRecordIndex:
     def getIndex(self) -> int:
         return self._index
 
+    def getCacheFileName(self) -> str:
+        return os.path.basename(self._download_url)
+
     def getCacheLocalFilePath(self) -> str:
-        p = os.path.basename(self._download_url)
+        p = self.getCacheFileName()
         p = _config.cache_path + f"/{p}"
         return p
 
     def hasCached(self) -> bool:
-        p = self.getCacheLocalFilePath()
-        if (p is None) | (not self._parent.isPublic()):
+        if not self._parent.isPublic():
             return False
-        return _path.exists(p) & _path.isfile(p)
+        return imgcache.has(self.getCacheFileName(), count=True)  # Answered by cache index, no file system access
 
     def getParent(self) -> ImageRecord:
         return self._parent
 
-    def addActionHistoryNonCommit(self, action_id: int):
-        conn = get_connection()
-        conn.execute("insert into history_details values (?,?,?)", (action_id, self._parent.getPid(), self._index))
+    def addActionHistory(self, action_id: int):
+        with transaction() as conn:
+            scope = conn.execute("select scope from history where action_id=?", (action_id,)).fetchone()
+            if scope is None:
+                raise ValueError(f"Action {action_id} does not exist!")
+            key = (scope[0], self._parent.getPid(), self._index)
+            conn.execute("insert into history_details values (?,?,?)", (action_id, key[1], key[2]))
+            after_commit(lambda: _sent.add(key))
 
     def getActionHistoryId(self) -> list:
         conn = get_connection()
         result = []
-        with conn.cursor() as f:
-            f.execute("select action_id from history_details where pix_image_index=? and pix_image_id=?", (self.getParent().getPid(), self.getIndex()))
-            l = f.fetchall()
-            for i in l:
-                result.append(i[0])
+        f = conn.cursor()
+        f.execute("select action_id from history_details where pix_image_id=? and pix_image_index=?",
+                  (self.getParent().getPid(), self.getIndex()))
+        l = f.fetchall()
+        for i in l:
+            result.append(i[0])
+        f.close()
         return result
 
+    def isSent(self, scope: str = "") -> bool:
+        return len(query_sent_pairs([(self._parent.getPid(), self._index)], scope)) > 0
 
-    def createCache(self, app: pixivpy3.AppPixivAPI, conf: _config.BotConf, force: bool = False):
-        p = self.getCacheLocalFilePath()
-        log.process(f"{self._parent.getPid()}_{self._index} - Download image to {p}'")
-        if not self._parent.isPublic():
-            log.failed(
-                f"{self._parent.getPid()}_{self._index} - Can not perform download due to image was set to non-public")
-            return
-
-        if os.path.exists(p):
-            if force:
-                log.failed(f"{self._parent.getPid()}_{self._index} - Previous cache was found. Do no modification!")
-                return
-            else:
-                log.debug(f"{self._parent.getPid()}_{self._index} - Previous cache will be override.")
-
-        pixiv_oauth.auto_token_valid_guard(app, conf)
-        if app.download(url=self._download_url, fname=p):
-            log.success(f"{self._parent.getPid()}_{self._index} - Save at {p}")
-        else:
-            log.success(f"{self._parent.getPid()}_{self._index} - Failed")
+    def createCache(self, app: pixivpy3.AppPixivAPI, conf: _config.BotConf, force: bool = False) -> bool:
+        return create_caches(app, conf, [self], force)[0].isSuccess()
 
 
 class HistoryAction:
     _id: int
     _type: history_action_type
+    _scope: str
     _details: list
 
     def getId(self) -> int:
@@ -188,100 +346,430 @@ class HistoryAction:
     def getType(self) -> history_action_type:
         return self._type
 
+    def getScope(self) -> str:
+        return self._scope
+
     def getDetails(self) -> list:
         return self._details
 
 
 # BASIC METHOD
+# Every thread owns its connection. Writes are grouped in transaction(), which serializes writers of this
+# process and commits once at the end, reading is done in autocommit mode so it never waits for writers (WAL).
 
 
-def clean_up_db():
-    global _con
-    if _con is None:
-        return
-    _con.commit()
-    _con.close()
+_loaded = False
+_local = threading.local()
+_connections: list = []  # Every opened connection, closed by clean_up_db()
+_connections_lock = threading.Lock()
+_write_lock = threading.RLock()
+_tracers: tuple = ()  # Called with every statement executed, for profiling. Replaced, never mutated.
+
+
+def _open_connection() -> Connection:
+    conn = sqlite3.connect(_config.database_filepath, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_connection_pragmas)
+    conn.set_trace_callback(_dispatch_trace if len(_tracers) > 0 else None)
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+
+def _dispatch_trace(statement: str):
+    for t in _tracers:
+        t(statement)
+
 
+def add_trace_callback(func):
+    """Trace every statement on every connection with func(statement). Nothing is traced without tracers."""
+    global _tracers
+    with _connections_lock:
+        if func not in _tracers:
+            _tracers = _tracers + (func,)
+        for c in _connections:
+            c.set_trace_callback(_dispatch_trace)
 
-def get_connection():
-    global _con
-    if _con is None:
+
+def remove_trace_callback(func):
+    global _tracers
+    with _connections_lock:
+        _tracers = tuple(t for t in _tracers if t is not func)
+        for c in _connections:
+            c.set_trace_callback(_dispatch_trace if len(_tracers) > 0 else None)
+
+
+def clean_up_db():
+    global _loaded
+    _loaded = False
+    own = getattr(_local, "conn", None)
+    with _connections_lock:
+        for c in _connections:
+            try:
+                if c.in_transaction:
+                    if c is not own:
+                        # Another thread is still writing, SQLite rolls it back if the process exits first.
+                        log.warn("Database connection of another thread is in a transaction, left open.")
+                        continue
+                    c.rollback()
+                c.close()
+            except sqlite3.Error as e:
+                log.warn(f"Failed to close database connection: {e}")
+        _connections.clear()
+    _local.__dict__.clear()
+
+
+def get_connection() -> Connection:
+    if not _loaded:
         raise ReferenceError("Did not load database!")
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.depth = 0
+        _local.on_commit = []
+    return conn
+
+
+@_contextmanager
+def transaction():
+    """
+    Unit of work on the connection of current thread. Nested calls join the outer transaction, which is
+    committed when the outermost one exits without exception and rolled back otherwise.
+    """
+    conn = get_connection()
+    if _local.depth > 0:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
 
-    return _con
+    st = time.perf_counter()
+    with _write_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        _local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            _local.depth = 0
+            _local.on_commit = []
+            conn.rollback()
+            raise
+        _local.depth = 0
+        conn.commit()
+        hooks = _local.on_commit
+        _local.on_commit = []
+    metrics.db_transaction_seconds.observe(time.perf_counter() - st)
+    for h in hooks:
+        h()
+
+
+def after_commit(func):
+    """Run func after the current transaction has been committed, or immediately outside of transaction."""
+    get_connection()
+    if _local.depth > 0:
+        _local.on_commit.append(func)
+    else:
+        func()
 
 
 def load_db():
-    global _con
-    c = False  # Is database new-created
-    if not (_path.exists(_config.database_filepath) | _path.isfile(_config.database_filepath)):
-        _Path(_config.database_filepath).touch()
-        c = True
+    global _loaded
+    existed = _path.isfile(_config.database_filepath)
+    _loaded = True
+    conn = get_connection()
+    with _write_lock:
+        _migrate(conn, existed)  # Backup is taken from the file as it was, before anything rewrites it
+        _enable_incremental_vacuum(conn, existed)
+    _load_sent_set()
+
+
+def _enable_incremental_vacuum(conn: Connection, existed: bool):
+    """
+    Free pages are given back by incremental_vacuum() in small steps, instead of a full VACUUM. VACUUM can not
+    run in a transaction, so instances starting together take turns through a lease and the later ones find it
+    done.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    owner = f"{socket.gethostname()}:{os.getpid()}"  # Instance id of config is not known yet
+    if not try_acquire_lease("rebuild_database", owner, _rebuild_lease_ttl):
+        log.process("Wait for another instance to rebuild database")
+        while not try_acquire_lease("rebuild_database", owner, _rebuild_lease_ttl):
+            time.sleep(1)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return  # Rebuilt by another instance meanwhile
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if existed:
+            log.process("Rebuild database once to enable incremental vacuum")
+        conn.execute("VACUUM")  # Takes effect only after the database has been rebuilt, even a new one in WAL mode
+    finally:
+        release_lease("rebuild_database", owner)
+
+
+def get_schema_version() -> int:
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+
+def _split_script(script: str) -> list:
+    """Statements of a migration script, so they can be executed in a transaction which is already open."""
+    result = []
+    current = ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            result.append(current.strip())
+            current = ""
+    if current.strip() != "":
+        result.append(current.strip())
+    return result
+
+
+def _migrate(conn: Connection, existed: bool):
+    """
+    Apply missing migrations one step at a time. Each step is applied atomically with its version number, and the
+    version is read again inside its transaction, so instances starting together never apply a step twice.
+    """
+    target = len(_migrations)
+    backed_up = not existed
+    upgraded = False
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > target:
+                raise RuntimeError(f"Database version {version} is newer than supported version {target}!")
+            if version == target:
+                conn.rollback()
+                break
+            if not backed_up:
+                # Keep a copy of the database before upgrading it in place. Read through another connection,
+                # which still sees the database as it was while this one holds the write lock (WAL).
+                bak = _config.database_filepath + f".v{version}.bak"
+                log.process(f"Backup database to '{bak}' before upgrading")
+                src = sqlite3.connect(_config.database_filepath)
+                b = sqlite3.connect(bak)
+                src.backup(b)
+                b.close()
+                src.close()
+                backed_up = True
+            log.process(f"Upgrade database from version {version} to {version + 1}")
+            for s in _split_script(_migrations[version]):
+                conn.execute(s)
+            conn.execute(f"PRAGMA user_version={version + 1}")
+            conn.commit()
+            upgraded = True
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+    if upgraded:
+        log.success(f"Database upgraded to version {target}")
+
+
+def _load_sent_set():
+    global _sent, _sent_action_id
+    conn = get_connection()
+    _sent_action_id = conn.execute("select coalesce(max(action_id), 0) from history").fetchone()[0]
+    crs = conn.cursor()
+    crs.execute("select distinct h.scope, d.pix_image_id, d.pix_image_index "
+                "from history_details d join history h on h.action_id=d.action_id where h.action_id<=?",
+                (_sent_action_id,))
+    _sent = {(r[0], str(r[1]), int(r[2])) for r in crs.fetchall()}
+    crs.close()
+    log.debug(f"Loaded {len(_sent)} sent image(s) from history.")
+
+
+def refresh_sent_set() -> int:
+    """
+    Load history written since the last load, which is history of other instances sharing this database.
+    Action ids are assigned in commit order, so nothing committed before the newest loaded one is missed.
+    Returns count of newly loaded images.
+    """
+    global _sent_action_id
+    rows = get_connection().execute("select h.action_id, h.scope, d.pix_image_id, d.pix_image_index "
+                                    "from history h join history_details d on h.action_id=d.action_id "
+                                    "where h.action_id>?", (_sent_action_id,)).fetchall()
+    before = len(_sent)
+    for r in rows:
+        _sent.add((r[1], str(r[2]), int(r[3])))
+        _sent_action_id = max(_sent_action_id, r[0])
+    return len(_sent) - before
+
+
+def _query_rollup(pairs: list, scope: str) -> set:
+    """Those of given (pid, index) pairs which are in sent_rollup of scope, looked up in one query."""
+    pids = list({int(p) for p, _ in pairs if p.isdigit()})
+    if len(pids) == 0:
+        return set()
+    rows = get_connection().execute(f"select pix_image_id, word, bits from sent_rollup where scope=? and "
+                                    f"pix_image_id in ({','.join('?' * len(pids))})", [scope] + pids).fetchall()
+    words = {(r[0], r[1]): r[2] for r in rows}
+    result = set()
+    for pid, index in pairs:
+        if pid.isdigit() and ((words.get((int(pid), index // _rollup_word), 0) >> (index % _rollup_word)) & 1):
+            result.add((pid, index))
+    return result
+
+
+def query_sent_pairs(pairs, scope: str = "") -> set:
+    """Return those of given (pid, index) pairs which have been sent already by watcher of scope."""
+    pairs = [(str(p), int(i)) for p, i in pairs]
+    result = {(p, i) for p, i in pairs if (scope, p, i) in _sent}
+    return result | _query_rollup([x for x in pairs if x not in result], scope)
+
+
+def filter_unsent_indexes(indexes: list, scope: str = "") -> list:
+    """Keep ImageRecordIndex which have not been sent yet by watcher of scope, in given order."""
+    rest = [i for i in indexes if (scope, i.getParent().getPid(), i.getIndex()) not in _sent]
+    rolled = _query_rollup([(i.getParent().getPid(), i.getIndex()) for i in rest], scope)
+    return [i for i in rest if (i.getParent().getPid(), i.getIndex()) not in rolled]
+
+
+def query_state(key: str) -> str:
+    crs = get_connection().cursor()
+    crs.execute("select state_value from state where state_key=?", (key,))
+    r = crs.fetchone()
+    crs.close()
+    if r is None:
+        return None
+    return r[0]
+
+
+def write_state(key: str, value: str):
+    with transaction() as conn:
+        conn.execute("insert or replace into state values (?,?)", (key, value))
 
-    _con = sqlite3.Connection(_config.database_filepath)
-    if c:
-        _con.executescript(_default_db_creation_sql)  # Create new database structure
-        _con.commit()
+
+def delete_state(key: str):
+    with transaction() as conn:
+        conn.execute("delete from state where state_key=?", (key,))
+
+
+# Leases
+
+_instance_id: str = None
+
+
+def get_instance_id(conf: _config.BotConf = None) -> str:
+    """Owner name of leases taken by this process, instance_id of conf or host name and pid."""
+    global _instance_id
+    if _instance_id is None:
+        if (conf is not None) and (conf.instance_id is not None):
+            _instance_id = conf.instance_id
+        else:
+            _instance_id = f"{socket.gethostname()}:{os.getpid()}"
+    return _instance_id
+
+
+def try_acquire_lease(job_name: str, owner: str, ttl: float) -> bool:
+    """
+    Take lease of job for ttl seconds. Fails while another owner holds a lease which has not expired. A lease
+    which has expired is taken over, its owner is considered dead.
+    """
+    now = time.time()
+    with transaction() as conn:
+        r = conn.execute("select owner, expires_at from job_lease where job_name=?", (job_name,)).fetchone()
+        if (r is not None) and (r[0] != owner) and (r[1] > now):
+            return False
+        if (r is not None) and (r[0] != owner):
+            log.warn(f"Lease of job '{job_name}' held by '{r[0]}' expired {now - r[1]:.0f}s ago, take it over.")
+        conn.execute("insert or replace into job_lease values (?,?,?,?,?)", (job_name, owner, now, now, now + ttl))
+    return True
+
+
+def renew_lease(job_name: str, owner: str, ttl: float) -> bool:
+    """Heartbeat of a lease. Returns False if the lease has been taken over by another owner."""
+    now = time.time()
+    with transaction() as conn:
+        n = conn.execute("update job_lease set heartbeat_at=?, expires_at=? where job_name=? and owner=?",
+                         (now, now + ttl, job_name, owner)).rowcount
+    return n > 0
+
+
+def release_lease(job_name: str, owner: str):
+    with transaction() as conn:
+        conn.execute("delete from job_lease where job_name=? and owner=?", (job_name, owner))
 
 
 # Utilites
 
 
 def valid_uid(conf: _config.BotConf, record: ImageRecord) -> bool:
-    include = record.getUid() in conf.image_uid_filter
-    if conf.image_uid_filter_as_whitelist:
-        return include
-    return not include
+    return image_filter.get_filter_set(conf).getDefault().validUid(record)
 
 
 def valid_tag(conf: _config.BotConf, record: ImageRecord) -> bool:
-    include = False
-    tgs = record.getTags()
-    for t in conf.image_tag_filter:
-        if t in tgs:
-            include = True
-            break
-    if conf.image_tag_filter_as_whitelist:
-        return include
-    return not include
+    return image_filter.get_filter_set(conf).getDefault().validTag(record)
 
 
 def valid_pid(conf: _config.BotConf, record: ImageRecord) -> bool:
-    include = record.getPid() in conf.image_pid_filter
-    if conf.image_pid_filter_as_whitelist:
-        return include
-    return not include
+    return image_filter.get_filter_set(conf).getDefault().validPid(record)
 
 
 def valid_policy(conf: _config.BotConf, record: ImageRecord) -> bool:
-    policy = conf.show_policy_limited_image
-    target = typing.cast(record.getPolicy(), int)
-    if policy == 0:
-        return target == 0
-    if policy == 1:
-        return target <= 1
-    if policy == 2:
-        return target == 0 | target == 2
-    if policy == 3:
-        return True
-    return False
+    return image_filter.get_filter_set(conf).getDefault().validPolicy(record)
+
+
+def create_caches(app: pixivpy3.AppPixivAPI, conf: _config.BotConf, indexes: list, force: bool = False) -> list:
+    """Download images of given ImageRecordIndex concurrently. Returns pixiv_download.DownloadResult for each."""
+    with metrics.cache_batch_seconds.time():
+        results = pixiv_download.download_images(app, conf, indexes, force)
+        with transaction():
+            _index_downloads(results)
+    return results
+
+
+def _index_downloads(results: list):
+    for r in results:
+        idx = r.getIndex()
+        if r.isSkipped():
+            imgcache.touch(idx.getCacheFileName())
+        elif r.isSuccess():
+            imgcache.put(idx.getCacheFileName(), idx.getParent().getPid(), idx.getIndex(),
+                         r.getSize(), r.getChecksum())
+        elif imgcache.has(idx.getCacheFileName()) and not os.path.exists(idx.getCacheLocalFilePath()):
+            imgcache.remove(idx.getCacheFileName())  # Old file went away while a forced download failed.
+
+
+def _is_supported_illust(json: dict) -> bool:
+    return ("type" in json) and (json["type"] in ("illust", "manga"))
 
 
 def get_image_pid(json: dict) -> str:
-    if ('type' not in json) | (json["type"] != ("illust" or "manga")):
+    if not _is_supported_illust(json):
         return None
     return json["id"]
 
 
-def create_image_record_from_response_non_commit(json: dict) -> ImageRecord:
-    if ('type' not in json) | (json["type"] != ("illust" or "manga")):
+def get_illust_digest(json: dict) -> str:
+    """Hash of the parts of illust json which are persisted in record and record_tag."""
+    single = json.get("meta_single_page") or {}
+    parts = [
+        str(json["id"]),
+        json.get("type"),
+        str(json["user"]["id"]),
+        json.get("x_restrict", 0),
+        [t["name"] for t in json.get("tags", [])],
+        single.get("original_image_url"),
+        [m["image_urls"]["original"] for m in json.get("meta_pages") or []],
+    ]
+    return hashlib.sha1(_json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def parse_image_record(json: dict) -> ImageRecord:
+    """Parse illust json into ImageRecord without touching database."""
+    if not _is_supported_illust(json):
         return None
 
     rec = ImageRecord()
-    rec._pid = json["id"]
+    rec._pid = str(json["id"])
     rec._uid = str(json["user"]["id"])
     rec._url = f"https://www.pixiv.net/artworks/{rec._pid}"
-    rec._policy = 0  # I'm not sure which flags means to policy
+    rec._policy = pic_policy_type(json.get("x_restrict", 0))  # 1 means R-18, 2 means R-18G
     rec._tags = []
     origint_tags = json["tags"]
     for tag in origint_tags:
@@ -294,7 +782,7 @@ def create_image_record_from_response_non_commit(json: dict) -> ImageRecord:
         idx._download_url = json["meta_single_page"]["original_image_url"]
         rec._indexes = [idx]
     else:
-        if ("meta_pages" in json) & (len(json["meta_pages"]) > 0):
+        if ("meta_pages" in json) and (len(json["meta_pages"]) > 0):
             l = []
             ii = 0
             for meta in json["meta_pages"]:
@@ -308,74 +796,191 @@ def create_image_record_from_response_non_commit(json: dict) -> ImageRecord:
         else:
             raise ValueError("Given illust details is not valid!")
 
-    rec.removeDBNonCommit()
-    rec.writeDBNonCommit()
     return rec
 
 
+def create_image_records_from_page(illusts: list) -> list:
+    """
+    Parse a page of illust json into ImageRecord and write those which have been changed since last seen.
+    Unchanged illusts cost no write at all. Result is in the same order as given, None for invalid illust.
+    """
+    result = []
+    digests = {}
+    for i in illusts:
+        try:
+            rec = parse_image_record(i)
+        except (ValueError, KeyError, TypeError) as e:
+            log.debug(f"Illust has been skipped due to invalid json: '{i.get('id')}'")
+            rec = None
+        result.append(rec)
+        if rec is not None:
+            digests[rec.getPid()] = get_illust_digest(i)
+
+    if len(digests) == 0:
+        return result
+
+    # Compare with stored digests in one query.
+    pids = list(digests.keys())
+    crs = get_connection().cursor()
+    crs.execute(f"select pix_image_id, digest from record_digest where pix_image_id in ({','.join('?' * len(pids))})",
+                pids)
+    stored = {str(r[0]): r[1] for r in crs.fetchall()}
+    crs.close()
+    changed = [r for r in result if (r is not None) and (stored.get(r.getPid()) != digests[r.getPid()])]
+    if len(changed) == 0:
+        return result
+
+    with transaction() as conn:
+        conn.executemany("insert into record values (?,?,?,?,?,?) "
+                         "on conflict (pix_image_id, pix_image_index) do update set "
+                         "pix_creator_id=excluded.pix_creator_id, pix_policy=excluded.pix_policy, "
+                         "pix_url=excluded.pix_url, pix_download_path=excluded.pix_download_path",
+                         [(r._pid, i._index, r._uid, r._policy.value, r._url, i._download_url)
+                          for r in changed for i in r.getRecordIndex()])
+        conn.executemany("delete from record where pix_image_id=? and pix_image_index>=?",
+                         [(r._pid, len(r.getRecordIndex())) for r in changed])  # Pages removed by author
+        conn.executemany("delete from record_tag where pix_image_id=?", [(r._pid,) for r in changed])
+        conn.executemany("insert or ignore into record_tag values (?,?)",
+                         [(r._pid, t) for r in changed for t in r._tags])
+        conn.executemany("insert into record_digest values (?,?) "
+                         "on conflict (pix_image_id) do update set digest=excluded.digest",
+                         [(r._pid, digests[r._pid]) for r in changed])
+    log.debug(f"Updated {len(changed)} of {len(digests)} illust record(s).")
+    return result
+
+
+def create_image_record_from_response(json: dict) -> ImageRecord:
+    return create_image_records_from_page([json])[0]
+
+
+def _pack_illust(json: dict) -> bytes:
+    return zlib.compress(_json.dumps(json, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def _unpack_illust(body: bytes) -> dict:
+    return _json.loads(zlib.decompress(body).decode("utf-8"))
+
+
+def cache_illusts(illusts: list, ttl: float, force: bool = False) -> int:
+    """
+    Store illust json into illust_cache. Unless forced, an illust is only written if it is missing, changed or
+    older than half of ttl, so polling the same bookmark page again costs no write. Returns rows written.
+    """
+    if ttl <= 0:
+        return 0
+    latest = {}
+    for i in illusts:
+        if _is_supported_illust(i):
+            try:
+                latest[str(i["id"])] = (get_illust_digest(i), i)
+            except (KeyError, TypeError):
+                continue
+    if len(latest) == 0:
+        return 0
+
+    now = time.time()
+    pids = list(latest.keys())
+    stale = pids
+    if not force:
+        crs = get_connection().cursor()
+        crs.execute(f"select pix_image_id, digest, version, fetched_at from illust_cache "
+                    f"where pix_image_id in ({','.join('?' * len(pids))})", pids)
+        fresh = {str(r[0]) for r in crs.fetchall()
+                 if (r[1] == latest[str(r[0])][0]) and (r[2] == _illust_cache_version) and (r[3] + ttl / 2 > now)}
+        crs.close()
+        stale = [p for p in pids if p not in fresh]
+    if len(stale) == 0:
+        return 0
+
+    with transaction() as conn:
+        conn.executemany("insert into illust_cache values (?,?,?,?,?) "
+                         "on conflict (pix_image_id) do update set body=excluded.body, digest=excluded.digest, "
+                         "version=excluded.version, fetched_at=excluded.fetched_at",
+                         [(p, _pack_illust(latest[p][1]), latest[p][0], _illust_cache_version, now) for p in stale])
+    return len(stale)
+
+
+def query_illust_json(pid: str, ttl: float) -> dict:
+    """Cached illust json of pid, None if it is missing or older than ttl seconds."""
+    if ttl <= 0:
+        return None
+    crs = get_connection().cursor()
+    crs.execute("select body from illust_cache where pix_image_id=? and version=? and fetched_at>?",
+                (str(pid), _illust_cache_version, time.time() - ttl))
+    row = crs.fetchone()
+    crs.close()
+    if row is None:
+        return None
+    return _unpack_illust(row[0])
+
+
+def purge_illust_cache(ttl: float) -> int:
+    """Remove expired or outdated rows of illust_cache, returns rows removed."""
+    with transaction() as conn:
+        crs = conn.execute("delete from illust_cache where fetched_at<=? or version<>?",
+                           (time.time() - max(0, ttl), _illust_cache_version))
+        return crs.rowcount
+
+
 def query_image_record(pid: str) -> ImageRecord:
+    return query_image_records([pid]).get(str(pid))
+
+
+def query_image_records(pids: list) -> dict:
+    """ImageRecord of each given pid which has a record, by pid. Records and tags are read with one query each."""
+    pids = list({str(p) for p in pids})
+    if len(pids) == 0:
+        return {}
     con = get_connection()
+    marks = ','.join('?' * len(pids))
     # Create ImageRecords.
-    imageCrs = con.cursor()
-    imageCrs.execute("select * from record where pix_image_id=? order by pix_image_index", (pid,))
-    iidx = imageCrs.fetchall()
-    if len(iidx) == 0:
-        return None  # do no effort on an empty target.
-
-    # Create base object
-    f = iidx[0]
-    rec = ImageRecord()
-    rec._pid = f["pix_image_id"]
-    rec._uid = f["pix_creator_id"]
-    rec._url = f["pix_url"]
-    rec._policy = f["pix_policy"]
-
-    # Create index
-    idx_list = []
-    idx = 0
-    for i in iidx:
+    result = {}
+    for i in con.execute(f"select * from record where pix_image_id in ({marks}) "
+                         f"order by pix_image_id, pix_image_index", pids).fetchall():
+        rec = result.get(str(i["pix_image_id"]))
+        if rec is None:
+            rec = ImageRecord()
+            rec._pid = i["pix_image_id"]
+            rec._uid = i["pix_creator_id"]
+            rec._url = i["pix_url"]
+            rec._policy = pic_policy_type(i["pix_policy"])
+            rec._indexes = []
+            rec._tags = []
+            result[str(rec._pid)] = rec
         c = ImageRecordIndex()
-        c._index = idx
+        c._index = i["pix_image_index"]
         c._download_url = i["pix_download_path"]
         c._parent = rec
-        idx_list.append(c)
-    rec._indexes = idx_list
-    imageCrs.close()
+        rec._indexes.append(c)
 
     # Write tags
-    tagCrs = con.cursor()
-    tagCrs.execute("select tag from record_tag where pix_image_id=?", (pid,))
-    tagTuple = tagCrs.fetchall()
-    rec._tags = []
-    for t in tagTuple:
-        rec._tags.append(t[0])
-
-    tagCrs.close()
-
-
-def create_action_history_non_commit(action_type: history_action_type, action_details) -> HistoryAction:
-    conn = get_connection()
-    hid = 0
+    for t in con.execute(f"select pix_image_id, tag from record_tag where pix_image_id in ({marks})", pids):
+        rec = result.get(str(t[0]))
+        if rec is not None:
+            rec._tags.append(t[1])
+    return result
 
-    # Get top id in history actions.
-    with conn.cursor() as tc:
-        tc.execute("select action_id from history order by action_id desc limit 1")
-        tc_tup = tc.fetchone()
-        if tc_tup is not None:
-            hid = tc_tup[0]
 
-    # Insert action into database
-    conn.execute("insert into history values (?, ?)", (hid, action_type))
+def create_action_history(action_type: history_action_type, action_details, scope: str = "") -> HistoryAction:
+    if isinstance(action_type, history_action_type):
+        action_type = action_type.value
     res = HistoryAction()
-    res._id = hid
     res._type = action_type
+    res._scope = scope
+    res._details = []
+
+    with transaction() as conn:
+        # Insert action into database, id is assigned by database.
+        hid = conn.execute("insert into history(action_type, scope, created_at) values (?,?,?)",
+                           (action_type, scope, time.time())).lastrowid
+        res._id = hid
 
-    # if action_details is not None, fill them into db.
-    if action_details is not None:
-        for d in action_details:
-            if isinstance(d, ImageRecordIndex):
-                conn.execute("insert into history_details values (?,?,?)", (hid, d.getParent().getPid(), d.getIndex()))
-        res._details = action_details
+        # if action_details is not None, fill them into db.
+        if action_details is not None:
+            pairs = [(d.getParent().getPid(), d.getIndex()) for d in action_details if isinstance(d, ImageRecordIndex)]
+            conn.executemany("insert into history_details values (?,?,?)", [(hid, p, i) for p, i in pairs])
+            after_commit(lambda: _sent.update((scope, p, i) for p, i in pairs))
+            res._details = action_details
 
     return res
 
@@ -386,24 +991,307 @@ def query_action_history(action_id: int) -> HistoryAction:
     conn = get_connection()
 
     # Fetch action basic info
-    with conn.cursor() as main:
-        main.execute("select * from history where action_id=?", (action_id,))
-        mm = main.fetchone()
-        if mm is None:
-            return None
-        res._id = action_id
-        res._type = mm[1]
-
-    with conn.cursor() as details:
-        details.execute("select pix_image_id, pix_image_index from history_details where action_id=?", (action_id,))
-        while True:
-            cur = details.fetchone()
-            if cur is None:
-                break
-            id = cur[0]
-            index = cur[1]
-            pic = query_image_record(id)
-            target = pic.getRecordIndex()[index]
-            res._details.append(target)
+    mm = conn.execute("select action_type, scope from history where action_id=?", (action_id,)).fetchone()
+    if mm is None:
+        return None
+    res._id = action_id
+    res._type = mm[0]
+    res._scope = mm[1]
+
+    details = conn.execute("select pix_image_id, pix_image_index from history_details where action_id=?",
+                           (action_id,)).fetchall()
+    for cur in details:
+        id = cur[0]
+        index = cur[1]
+        pic = query_image_record(id)
+        if pic is None:
+            continue  # Record has been removed
+        for target in pic.getRecordIndex():
+            if target.getIndex() == index:
+                res._details.append(target)
+
+    return res
+
 
+# Outbox
+
+def enqueue_outbox(indexes: list, scope: str = "") -> int:
+    """Queue ImageRecordIndex to be sent by watcher of scope, in given order. Queued ones are left untouched."""
+    now = time.time()
+    rows = [(scope, i.getParent().getPid(), i.getIndex(), now, now) for i in indexes]
+    with transaction() as conn:
+        n = conn.executemany("insert or ignore into outbox(scope, pix_image_id, pix_image_index, enqueued_at, "
+                             "updated_at) values (?,?,?,?,?)", rows).rowcount
+    return max(0, n)
+
+
+def recover_outbox(conf: _config.BotConf, scope: str = "") -> int:
+    """
+    Put items left in downloading or uploading by a run which has not finished (killed process, lost lease) back
+    to pending, counted as an attempt. Only call it while holding the lease of scope.
+    """
+    with transaction() as conn:
+        rows = conn.execute("select pix_image_id, pix_image_index from outbox where scope=? and state in (?,?)",
+                            (scope, outbox_state.downloading.value, outbox_state.uploading.value)).fetchall()
+        _retry(conn, conf, scope, [(r[0], r[1]) for r in rows], "interrupted", False, backoff=False)
+    return len(rows)
+
+
+def claim_outbox(scope: str, limit: int) -> list:
+    """Mark at most limit due items of scope as downloading, oldest first. Returns their ImageRecordIndex."""
+    now = time.time()
+    with transaction() as conn:
+        rows = conn.execute("select pix_image_id, pix_image_index from outbox where scope=? and state=? and "
+                            "next_retry<=? order by outbox_id limit ?",
+                            (scope, outbox_state.pending.value, now, limit)).fetchall()
+        result, missing = _outbox_indexes(rows)
+        set_outbox_state(result, outbox_state.downloading, scope)
+        conn.executemany("update outbox set state=?, error='record removed' where scope=? and pix_image_id=? and "
+                         "pix_image_index=?", [(outbox_state.failed.value, scope, p, i) for p, i in missing])
+    return result
+
+
+def peek_outbox(scope: str, limit: int) -> list:
+    """ImageRecordIndex of at most limit pending items of scope in sending order, due or not. Nothing is claimed."""
+    rows = get_connection().execute("select pix_image_id, pix_image_index from outbox where scope=? and state=? "
+                                    "order by outbox_id limit ?", (scope, outbox_state.pending.value, limit)).fetchall()
+    return _outbox_indexes(rows)[0]
+
+
+def _outbox_indexes(rows: list) -> tuple:
+    """ImageRecordIndex of (pid, index) rows, and those rows whose record has been removed."""
+    records = query_image_records([r[0] for r in rows])
+    result = []
+    missing = []
+    for pid, index in rows:
+        idx = None
+        if str(pid) in records:
+            idx = next((i for i in records[str(pid)].getRecordIndex() if i.getIndex() == index), None)
+        if idx is None:
+            missing.append((pid, index))
+            continue
+        result.append(idx)
+    return result, missing
+
+
+def set_outbox_state(indexes: list, state: outbox_state, scope: str = ""):
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany("update outbox set state=?, updated_at=? where scope=? and pix_image_id=? and "
+                         "pix_image_index=?",
+                         [(state.value, now, scope, i.getParent().getPid(), i.getIndex()) for i in indexes])
+
+
+def complete_outbox(action_type: history_action_type, indexes: list, scope: str = "") -> HistoryAction:
+    """Mark items as sent and write them into history, in one transaction."""
+    with transaction():
+        res = create_action_history(action_type, indexes, scope)
+        set_outbox_state(indexes, outbox_state.sent, scope)
     return res
+
+
+def discard_outbox(indexes: list, scope: str = ""):
+    """Drop items which nobody would receive."""
+    with transaction() as conn:
+        conn.executemany("delete from outbox where scope=? and pix_image_id=? and pix_image_index=?",
+                         [(scope, i.getParent().getPid(), i.getIndex()) for i in indexes])
+
+
+def retry_outbox(conf: _config.BotConf, indexes: list, error: str, scope: str = "", permanent: bool = False) -> int:
+    """
+    Put failed items back to pending after a backoff, or into failed once outbox_max_attempts is reached or the
+    failure is permanent. Returns count of items which went into failed.
+    """
+    with transaction() as conn:
+        return _retry(conn, conf, scope, [(i.getParent().getPid(), i.getIndex()) for i in indexes], error, permanent)
+
+
+def _retry(conn: Connection, conf: _config.BotConf, scope: str, pairs: list, error: str, permanent: bool,
+           backoff: bool = True) -> int:
+    now = time.time()
+    failed = 0
+    for pid, index in pairs:
+        r = conn.execute("select attempts from outbox where scope=? and pix_image_id=? and pix_image_index=?",
+                         (scope, pid, index)).fetchone()
+        if r is None:
+            continue
+        attempts = r[0] + 1
+        if permanent or (attempts >= conf.outbox_max_attempts):
+            state = outbox_state.failed
+            failed += 1
+            log.failed(f"{pid}_{index} - Gave up sending after {attempts} attempt(s): {error}")
+        else:
+            state = outbox_state.pending
+        delay = min(conf.outbox_retry_cap, conf.outbox_retry_base * (2 ** (attempts - 1))) if backoff else 0
+        conn.execute("update outbox set state=?, attempts=?, next_retry=?, updated_at=?, error=? where scope=? and "
+                     "pix_image_id=? and pix_image_index=?",
+                     (state.value, attempts, now + delay, now, error, scope, pid, index))
+    metrics.items.inc("failed", amount=failed)
+    return failed
+
+
+def write_deliveries(groups: dict, scope: str = ""):
+    """Record groups which each ImageRecordIndex in groups has been sent to by watcher of scope."""
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany("insert or ignore into delivery values (?,?,?,?,?)",
+                         [(scope, i.getParent().getPid(), i.getIndex(), g, now)
+                          for i, gs in groups.items() for g in gs])
+
+
+def query_delivered_groups(pairs) -> dict:
+    """(pid, index) -> set of groups it has been sent to by any watcher, for each of given pairs in one query."""
+    result = {(str(p), int(i)): set() for p, i in pairs}
+    if len(result) == 0:
+        return result
+    pids = list({p for p, _ in result})
+    rows = get_connection().execute(f"select pix_image_id, pix_image_index, group_id from delivery "
+                                    f"where pix_image_id in ({','.join('?' * len(pids))})", pids).fetchall()
+    for r in rows:
+        groups = result.get((str(r[0]), int(r[1])))
+        if groups is not None:
+            groups.add(r[2])
+    return result
+
+
+def query_outbox_counts() -> dict:
+    """(scope, name of outbox_state) -> count of items."""
+    rows = get_connection().execute("select scope, state, count(*) from outbox group by scope, state").fetchall()
+    return {(r[0], outbox_state(r[1]).name): r[2] for r in rows}
+
+
+_outbox_gauge = metrics.Gauge("outbox_items", "Outbox items by watcher and state.", ("watcher", "state"),
+                              func=query_outbox_counts)
+
+
+# Perceptual hash
+
+def _to_signed64(h: int) -> int:
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def _to_unsigned64(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
+
+
+def write_image_hashes(hashes: dict):
+    """Store dHash of each ImageRecordIndex in hashes."""
+    with transaction() as conn:
+        conn.executemany("insert or replace into image_phash values (?,?,?)",
+                         [(i.getParent().getPid(), i.getIndex(), _to_signed64(h)) for i, h in hashes.items()])
+
+
+def query_image_hashes(indexes: list) -> dict:
+    """Stored dHash of given ImageRecordIndex in one query, those without hash are left out."""
+    if len(indexes) == 0:
+        return {}
+    pids = list({i.getParent().getPid() for i in indexes})
+    rows = get_connection().execute(f"select pix_image_id, pix_image_index, phash from image_phash "
+                                    f"where pix_image_id in ({','.join('?' * len(pids))})", pids).fetchall()
+    stored = {(str(r[0]), int(r[1])): r[2] for r in rows}
+    result = {}
+    for i in indexes:
+        h = stored.get((i.getParent().getPid(), i.getIndex()))
+        if h is not None:
+            result[i] = _to_unsigned64(h)
+    return result
+
+
+def query_last_action_id() -> int:
+    return get_connection().execute("select coalesce(max(action_id), 0) from history").fetchone()[0]
+
+
+def query_sent_hashes(after_action_id: int, until_action_id: int) -> list:
+    """
+    (scope, pid, index, dHash) of images sent by actions in (after_action_id, until_action_id]. Loading from the
+    start (after_action_id 0) includes images whose history has been rolled up, read in the same query so a
+    rollup in between can not move any of them out of sight.
+    """
+    sql = ("select h.scope, d.pix_image_id, d.pix_image_index, p.phash "
+           "from history h join history_details d on h.action_id=d.action_id "
+           "join image_phash p on p.pix_image_id=d.pix_image_id and "
+           "p.pix_image_index=d.pix_image_index where h.action_id>? and h.action_id<=?")
+    if after_action_id == 0:
+        sql += " union all select scope, pix_image_id, pix_image_index, phash from sent_phash"
+    rows = get_connection().execute(sql, (after_action_id, until_action_id)).fetchall()
+    return [(r[0], str(r[1]), int(r[2]), _to_unsigned64(r[3])) for r in rows]
+
+
+# Retention
+
+def _prune_records(conn: Connection, pids: set):
+    """
+    Remove records of pids which are neither in history nor waiting in outbox. Hashes of sent ones have been
+    kept in sent_phash by then.
+    """
+    for pid in pids:
+        if conn.execute("select 1 from history_details where pix_image_id=? limit 1", (pid,)).fetchone() is not None:
+            continue
+        if conn.execute("select 1 from outbox where pix_image_id=? and state in (?,?,?) limit 1",
+                        (pid, outbox_state.pending.value, outbox_state.downloading.value,
+                         outbox_state.uploading.value)).fetchone() is not None:
+            continue
+        for table in ("record", "record_tag", "record_digest", "image_phash"):
+            conn.execute(f"delete from {table} where pix_image_id=?", (pid,))
+
+
+def compact_history(conf: _config.BotConf) -> int:
+    """
+    Roll history older than history_retention_days up into sent_rollup, which still answers whether an image has
+    been sent, keep dHash of sent images in sent_phash, and drop records nothing refers to any more. Works in
+    batches of _rollup_batch actions, each in its own short transaction. Returns count of actions rolled up.
+    """
+    if conf.history_retention_days <= 0:
+        return 0
+    cutoff = time.time() - conf.history_retention_days * 86400
+    total = 0
+    while True:
+        with transaction() as conn:
+            ids = [r[0] for r in conn.execute("select action_id from history where created_at<? order by action_id "
+                                              "limit ?", (cutoff, _rollup_batch)).fetchall()]
+            if len(ids) == 0:
+                break
+            marks = ",".join("?" * len(ids))
+            rows = conn.execute("select h.scope, d.pix_image_id, d.pix_image_index from history h join "
+                                f"history_details d on h.action_id=d.action_id where h.action_id in ({marks})",
+                                ids).fetchall()
+            words = {}
+            for scope, pid, index in rows:
+                if not str(pid).isdigit():
+                    continue
+                key = (scope, int(pid), int(index) // _rollup_word)
+                words[key] = words.get(key, 0) | (1 << (int(index) % _rollup_word))
+            conn.executemany("insert into sent_rollup values (?,?,?,?) on conflict(scope, pix_image_id, word) "
+                             "do update set bits=bits|excluded.bits", [k + (v,) for k, v in words.items()])
+            conn.execute("insert or ignore into sent_phash select h.scope, d.pix_image_id, d.pix_image_index, p.phash "
+                         "from history h join history_details d on h.action_id=d.action_id join image_phash p on "
+                         "p.pix_image_id=d.pix_image_id and p.pix_image_index=d.pix_image_index "
+                         f"where h.action_id in ({marks})", ids)
+            conn.execute(f"delete from history_details where action_id in ({marks})", ids)
+            conn.execute(f"delete from history where action_id in ({marks})", ids)
+            _prune_records(conn, {str(r[1]) for r in rows})
+            rolled = {(r[0], str(r[1]), int(r[2])) for r in rows}
+            after_commit(lambda: _sent.difference_update(rolled))
+        total += len(ids)
+
+    with transaction() as conn:
+        conn.execute("delete from outbox where state=? and updated_at<?", (outbox_state.sent.value, cutoff))
+        conn.execute("delete from delivery where sent_at<?", (cutoff,))
+    return total
+
+
+def incremental_vacuum(max_pages: int = None) -> int:
+    """Give free pages back to file system, _vacuum_step pages per transaction. Returns count of pages."""
+    conn = get_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    freed = 0
+    while (max_pages is None) or (freed < max_pages):
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free == 0:
+            break
+        step = min(free, _vacuum_step)
+        with transaction() as c:
+            c.execute(f"PRAGMA incremental_vacuum({step})").fetchall()
+        freed += step
+    return freed
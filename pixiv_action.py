@@ -1,50 +1,236 @@
+import json
+import image_filter
+import metrics
 import pixiv_oauth as oauth
 from picdb import *
 import config
 
 
-def fetch_bookmarks(app: pixivpy3.AppPixivAPI, conf: config.BotConf, count: int) -> list[ImageRecordIndex]:
-    conn = get_connection()
-    result: list = []
-    baseline = conf.check_bookmark_baseline_uid
-    while True:
-        resp = app.user_bookmarks_illust(user_id=conf.pixiv_user_watch_uid, restrict=conf.check_bookmark_restrict)
-        if oauth.should_retry_response(app, conf, resp): continue
-
-        # Start collect content.
-        illust = resp["illusts"]
-        for i in illust:
-            if len(result) >= count:  # Reach desired number.
-                break
-            # fetch new image of id
-            r: ImageRecord
-            try:
-                r = create_image_record_from_response_non_commit(i)
-            except ValueError as e:
-                log.debug(f"Illust has been skipped due to invalid json: '{i['id']}'")
-                continue
-
-            # Using filter
-            if r is None:
-                continue
-            if r.getPid() == baseline:
-                break  # Met baseline means the rest of illust should being disposed.
-            valid = valid_pid(conf, r) & valid_tag(conf, r) & valid_uid(conf, r) & valid_policy(conf, r)
-            if not valid:
-                continue # Skip if not valid
-
-            # fetch actually image.
-            for j in r.getRecordIndex():
-                if isinstance(j, ImageRecordIndex):
-                    hasHistory = j.getActionHistoryId()
-                    if len(hasHistory) == 0: # Has not been sent yet.
-                        result.append(j)
-                if len(result) >= count:  # Reach desired number.
+_max_auth_retries = 2
+_mark_size = 30  # Newest bookmarks kept as high-water mark, one page of Pixiv
+
+
+def _state_key(conf: config.BotConf, prefix: str) -> str:
+    key = f"{prefix}:{conf.pixiv_user_watch_uid}:{conf.check_bookmark_restrict}"
+    if conf.watcher_name != "":
+        key += f":{conf.watcher_name}"  # Watchers of the same user may have different filters
+    return key
+
+
+def _high_water_mark_key(conf: config.BotConf) -> str:
+    return _state_key(conf, "bookmark_high_water_mark")
+
+
+def _resume_key(conf: config.BotConf) -> str:
+    return _state_key(conf, "bookmark_resume")
+
+
+def _load_marks(value: str) -> list:
+    if value is None:
+        return []
+    if value.startswith("["):
+        return json.loads(value)
+    return [value]  # Stored before several bookmarks were kept
+
+
+class BookmarkCrawler:
+    """
+    Walk bookmarks of watching user from the newest one, page by page, and stop at the high-water mark (the
+    newest _mark_size bookmarks seen in the last completed cycle, so removing some of them does not lose the
+    mark). Everything is fetched lazily, so a cycle without any new bookmark costs exactly one request. A walk
+    stopped by check_bookmark_max_pages is resumed by the next cycle from where it stopped, and the mark only
+    moves once the resumed walk has reached it or has covered check_bookmark_max_walk_pages.
+    """
+    _app: pixivpy3.AppPixivAPI
+    _conf: config.BotConf
+    _marks: list  # Newest first
+    _recent: list  # Newest bookmarks of this walk, newest first
+    _completed: bool
+    _pages: int
+    _walked: int  # Pages of this walk, including those walked by previous cycles
+    _cursor: dict  # Query of the page to resume walking from, None starts from the newest bookmark
+    _stopped: dict  # Query of the page which was not walked for page limit
+
+    def __init__(self, app: pixivpy3.AppPixivAPI, conf: config.BotConf):
+        self._app = app
+        self._conf = conf
+        self._marks = _load_marks(query_state(_high_water_mark_key(conf)))
+        if (len(self._marks) == 0) and (conf.check_bookmark_baseline_uid is not None):
+            self._marks = [conf.check_bookmark_baseline_uid]  # No cycle was completed yet. Using static baseline.
+        self._recent = []
+        self._completed = False
+        self._pages = 0
+        self._walked = 0
+        self._cursor = None
+        self._stopped = None
+        resume = query_state(_resume_key(conf))
+        if resume is not None:
+            resume = json.loads(resume)
+            self._cursor = resume["cursor"]
+            newest = resume["newest"]  # Newest bookmarks of the walk being resumed
+            self._recent = newest if isinstance(newest, list) else [newest]
+            self._walked = resume.get("pages", 0)
+
+    def getHighWaterMark(self) -> str:
+        return self._marks[0] if len(self._marks) > 0 else None
+
+    def getNewest(self) -> str:
+        return self._recent[0] if len(self._recent) > 0 else None
+
+    def getPageCount(self) -> int:
+        return self._pages
+
+    def isCompleted(self) -> bool:
+        return self._completed
+
+    def isResumed(self) -> bool:
+        return self._cursor is not None
+
+    def pages(self):
+        """Yield illust json lists page by page, only including bookmarks newer than high-water mark."""
+        app = self._app
+        conf = self._conf
+        kwargs = self._cursor
+        if kwargs is None:
+            kwargs = {"user_id": conf.pixiv_user_watch_uid, "restrict": conf.check_bookmark_restrict}
+        marks = set(self._marks)
+        retries = 0
+        while kwargs is not None:
+            if self._pages >= conf.check_bookmark_max_pages:
+                if len(marks) == 0:
+                    # Without any mark every bookmark is new, so the very first walk is bounded by page limit.
+                    log.debug(f"Bookmark crawler stopped by page limit ({conf.check_bookmark_max_pages}).")
+                    break
+                if self._walked >= conf.check_bookmark_max_walk_pages:
+                    # The mark may be gone for good (unbookmarked or made private), do not walk whole collection.
+                    log.warn(f"Bookmark crawler did not meet high-water mark in {self._walked} page(s), older "
+                             f"bookmarks are left out.", watcher=conf.watcher_name)
+                    break
+                # Not completed, the mark stays until the rest has been walked from here.
+                self._stopped = kwargs
+                log.warn(f"Bookmark crawler stopped by page limit ({conf.check_bookmark_max_pages}), "
+                         f"next cycle resumes from there.", watcher=conf.watcher_name)
+                return
+            oauth.auto_token_valid_guard(app, conf)
+            gen = oauth.get_generation()
+            resp = app.user_bookmarks_illust(**kwargs)
+            if oauth.should_retry_response(app, conf, resp, seen_generation=gen):
+                retries += 1
+                if retries <= _max_auth_retries:
+                    continue
+            if not oauth.validate_response(resp, False):
+                # Walking is not completed, so high-water mark stays and next cycle will walk again.
+                log.failed(f"Failed to fetch bookmarks: '{resp['error'].get('message')}'")
+                return
+            retries = 0
+            self._pages += 1
+            self._walked += 1
+            metrics.poll_pages.inc()
+
+            page = []
+            met_mark = False
+            for i in resp["illusts"]:
+                pid = str(i["id"])
+                if len(self._recent) < _mark_size:
+                    self._recent.append(pid)
+                if pid in marks:  # Met high-water mark means the rest of illust has been walked through.
+                    met_mark = True
                     break
+                page.append(i)
+            if len(page) > 0:
+                yield page  # Completion is only marked after consumer has finished with the page.
+            if met_mark:
+                self._completed = True
+                return
+
+            kwargs = app.parse_qs(resp.get("next_url"))
+        self._completed = True
+
+    def candidates(self):
+        """Yield ImageRecordIndex which passed filters and has not been sent yet."""
+        filters = image_filter.get_filter_set(self._conf)
+        for page in self.pages():
+            indexes = []
+            records = create_image_records_from_page(page)  # One transaction per page
+            cache_illusts(page, self._conf.illust_cache_ttl)
+            filtered = 0
+            for r, valid in zip(records, filters.evaluate(records)):
+                if not valid:
+                    filtered += 0 if r is None else len(r.getRecordIndex())
+                    continue  # Skip if invalid or filtered
+                indexes.extend(j for j in r.getRecordIndex() if isinstance(j, ImageRecordIndex))
+
+            # Check sent state of whole page at once.
+            unsent = filter_unsent_indexes(indexes, self._conf.watcher_name)
+            metrics.items.inc("found", amount=len(indexes) + filtered)
+            metrics.items.inc("filtered", amount=filtered)
+            metrics.items.inc("already_sent", amount=len(indexes) - len(unsent))
+            for j in unsent:
+                yield j
+
+    def commitHighWaterMark(self) -> bool:
+        """
+        Persist the newest bookmarks as high-water mark if walking was completed, or where to resume walking if
+        it was stopped by page limit. Returns True if the mark has moved.
+        """
+        if (self._stopped is not None) & (len(self._recent) > 0):
+            write_state(_resume_key(self._conf), json.dumps({"cursor": self._stopped, "newest": self._recent,
+                                                             "pages": self._walked}))
+            return False
+        if not self._completed:
+            return False
+        marks = list(dict.fromkeys(self._recent + self._marks))[:_mark_size]  # Walked ones are newer
+        moved = marks != self._marks
+        with transaction():
+            if self._cursor is not None:
+                delete_state(_resume_key(self._conf))
+            if moved:
+                write_state(_high_water_mark_key(self._conf), json.dumps(marks))
+        if moved:
+            self._marks = marks
+        return moved
+
+
+def get_illust_detail(app: pixivpy3.AppPixivAPI, conf: config.BotConf, pid: str, force: bool = False) -> dict:
+    """Illust json of pid. illust_cache is consulted first, so a pid seen recently costs no request."""
+    if not force:
+        cached = query_illust_json(pid, conf.illust_cache_ttl)
+        if cached is not None:
+            return cached
+
+    retries = 0
+    while True:
+        oauth.auto_token_valid_guard(app, conf)
+        gen = oauth.get_generation()
+        resp = app.illust_detail(pid)
+        if oauth.should_retry_response(app, conf, resp, seen_generation=gen) and (retries < _max_auth_retries):
+            retries += 1
+            continue
+        break
+    if not oauth.validate_response(resp, False):
+        log.failed(f"Failed to fetch illust {pid}: '{resp['error'].get('message')}'")
+        return None
+
+    illust = resp["illust"]
+    create_image_record_from_response(illust)
+    cache_illusts([illust], conf.illust_cache_ttl, force=True)
+    return illust
+
 
-        if len(result) >= count:  # Reach desired number.
-            break
+def poll_bookmarks(app: pixivpy3.AppPixivAPI, conf: config.BotConf) -> int:
+    """
+    Queue every new image into outbox of the watcher, so high-water mark can always move to the newest bookmark.
+    Returns count of newly queued images.
+    """
+    crawler = BookmarkCrawler(app, conf)
+    with metrics.poll_seconds.time(conf.watcher_name):
+        found = list(crawler.candidates())
+        queued = enqueue_outbox(found, conf.watcher_name) if len(found) > 0 else 0
+    metrics.items.inc("queued", amount=queued)
 
-    conn.commit()  # Apply modifications.
-    return result
+    # Queued before the mark is moved, a cycle dying in between only walks the same bookmarks again.
+    if crawler.commitHighWaterMark():
+        log.debug(f"Bookmark high-water mark moved to {crawler.getHighWaterMark()}.")
+    log.debug(f"Bookmark crawler walked {crawler.getPageCount()} page(s), queued {queued} image(s).")
+    return queued
 
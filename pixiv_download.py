@@ -0,0 +1,282 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+import requests as _requests
+from requests.adapters import HTTPAdapter as _HTTPAdapter
+import pixivpy3 as _pixiv
+import config as _config
+import log
+import metrics
+import pixiv_oauth
+import ratelimit
+
+_referer = "https://app-api.pixiv.net/"
+_user_agent = "PixivIOSApp/7.13.3 (iOS 14.6; iPhone13,2)"
+_chunk_size = 64 * 1024
+_throttle_status = (429, 503)
+_part_suffix = ".part"  # Unfinished download, renamed to the cache file once complete
+
+_session: _requests.Session = None
+_session_lock = threading.Lock()
+_inflight: dict = {}  # Cache file name -> DownloadResult of the batch which is downloading it
+_inflight_lock = threading.Lock()
+
+
+class DownloadResult:
+    _index: object  # picdb.ImageRecordIndex
+    _path: str
+    _success: bool
+    _skipped: bool
+    _size: int
+    _checksum: str
+    _elapsed: float
+    _error: str
+    _done: threading.Event
+
+    def __init__(self, index, path: str):
+        self._index = index
+        self._path = path
+        self._success = False
+        self._skipped = False
+        self._size = 0
+        self._checksum = None
+        self._elapsed = 0
+        self._error = None
+        self._done = threading.Event()
+
+    def getIndex(self):
+        return self._index
+
+    def getPath(self) -> str:
+        return self._path
+
+    def isSuccess(self) -> bool:
+        return self._success
+
+    def isSkipped(self) -> bool:
+        return self._skipped
+
+    def getSize(self) -> int:
+        return self._size
+
+    def getChecksum(self) -> str:
+        return self._checksum
+
+    def getElapsed(self) -> float:
+        return self._elapsed
+
+    def getError(self) -> str:
+        return self._error
+
+
+def _get_session(conf: _config.BotConf) -> _requests.Session:
+    """Shared keep-alive session for i.pximg.net, its pool is as large as download workers."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            s = _requests.Session()
+            adapter = _HTTPAdapter(pool_connections=1, pool_maxsize=max(1, conf.download_worker_count))
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            s.headers.update({"Referer": _referer, "User-Agent": _user_agent})
+            _session = s
+        return _session
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+class _Incomplete(IOError):
+    """Download stopped early, it can be resumed from what has been written."""
+
+
+_resumable_errors = (_Incomplete, _requests.ConnectionError, _requests.Timeout,
+                     _requests.exceptions.ChunkedEncodingError)
+
+
+def _file_sha1(path: str):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h
+
+
+def _get(session: _requests.Session, conf: _config.BotConf, url: str, headers: dict, name: str,
+         fields: dict) -> _requests.Response:
+    """GET through image bucket, waiting out throttling responses."""
+    bucket = ratelimit.get_image_bucket(conf)
+    attempt = 0
+    while True:
+        bucket.acquire()
+        resp = session.get(url, stream=True, timeout=conf.download_timeout, headers=headers)
+        if (resp.status_code not in _throttle_status) or (attempt >= conf.ratelimit_max_retries):
+            if resp.ok:
+                bucket.recover()
+            return resp
+        resp.close()
+        delay = ratelimit.backoff_delay(attempt, conf)
+        bucket.throttle(delay)
+        log.warn(f"{name} - Throttled by image server ({resp.status_code}), retry in {delay:.1f}s", **fields)
+        attempt += 1
+
+
+def _stream_to_part(session: _requests.Session, conf: _config.BotConf, url: str, part: str, name: str,
+                    fields: dict) -> tuple:
+    """
+    Append the rest of the file to part, asking for it with Range if part is not empty. Raises _Incomplete if
+    fewer bytes than announced by Content-Length arrived. Returns (size, sha1 of the whole file).
+    """
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else None
+    with _get(session, conf, url, headers, name, fields) as resp:
+        if resp.status_code == 416:
+            os.remove(part)  # Part is longer than the file, it is not the same file any more
+            raise _Incomplete("range not satisfiable, start over")
+        if resp.status_code >= 500:
+            raise _Incomplete(f"server error {resp.status_code}")
+        resp.raise_for_status()
+
+        if (resp.status_code == 206) and resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            h = _file_sha1(part)
+            mode = "ab"
+        else:
+            offset = 0  # Range was ignored, server sends the whole file
+            h = hashlib.sha1()
+            mode = "wb"
+        expected = None
+        if ("Content-Length" in resp.headers) and (resp.headers.get("Content-Encoding", "identity") == "identity"):
+            expected = offset + int(resp.headers["Content-Length"])
+
+        with open(part, mode) as f:
+            try:
+                for chunk in resp.iter_content(_chunk_size):
+                    f.write(chunk)
+                    h.update(chunk)
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+    size = os.path.getsize(part)
+    if (expected is not None) and (size != expected):
+        raise _Incomplete(f"received {size} of {expected} bytes")
+    return size, h.hexdigest()
+
+
+def _download_one(session: _requests.Session, conf: _config.BotConf, res: DownloadResult) -> DownloadResult:
+    """
+    Stream into a part file next to the cache file and rename it over the cache file once complete, so nobody
+    sees a partial image. Interrupted transfers are resumed with Range, also by later cycles.
+    """
+    idx = res.getIndex()
+    name = f"{idx.getParent().getPid()}_{idx.getIndex()}"
+    fields = {"pid": idx.getParent().getPid(), "index": idx.getIndex(), "stage": "download"}
+    log.process(f"{name} - Download image to {res._path}", **fields)
+    st = time.monotonic()
+    part = res._path + _part_suffix
+    resumes = 0
+    try:
+        while True:
+            try:
+                res._size, res._checksum = _stream_to_part(session, conf, idx._download_url, part, name, fields)
+                break
+            except _resumable_errors as e:
+                if resumes >= conf.download_resume_attempts:
+                    raise
+                resumes += 1
+                metrics.download_resumes.inc()
+                have = os.path.getsize(part) if os.path.exists(part) else 0
+                log.warn(f"{name} - Download interrupted at {have} bytes, resume "
+                         f"({resumes}/{conf.download_resume_attempts}): {e}", **fields)
+        os.replace(part, res._path)
+        res._success = True
+        res._elapsed = time.monotonic() - st
+        metrics.download_bytes.inc(amount=res._size)
+        metrics.download_seconds.observe(res._elapsed)
+        log.success(f"{name} - Save at {res._path} ({res._size} bytes in {res._elapsed:.2f}s)",
+                    duration=round(res._elapsed, 3), size=res._size, **fields)
+    except Exception as e:
+        res._error = str(e)
+        res._elapsed = time.monotonic() - st
+        metrics.download_failures.inc()
+        if (not isinstance(e, _resumable_errors)) and os.path.exists(part):
+            os.remove(part)  # Kept for the next cycle to resume only if the transfer broke
+        log.failed(f"{name} - Failed to download: {e}", duration=round(res._elapsed, 3), **fields)
+    return res
+
+
+def download_images(app: _pixiv.AppPixivAPI, conf: _config.BotConf, indexes: list, force: bool = False) -> list:
+    """
+    Download a batch of ImageRecordIndex into cache in parallel. Token will be checked only once per batch.
+    Returns DownloadResult for each given index in the same order.
+    """
+    results = []
+    todo = []
+    for idx in indexes:
+        res = DownloadResult(idx, idx.getCacheLocalFilePath())
+        results.append(res)
+        name = f"{idx.getParent().getPid()}_{idx.getIndex()}"
+        if not idx.getParent().isPublic():
+            res._error = "non-public"
+            log.failed(f"{name} - Can not perform download due to image was set to non-public")
+            continue
+        if idx.hasCached():
+            if not force:
+                res._success = True
+                res._skipped = True
+                log.debug(f"{name} - Previous cache was found. Do no modification!")
+                continue
+            log.debug(f"{name} - Previous cache will be override.")
+        todo.append(res)
+
+    if len(todo) == 0:
+        return results
+
+    # Another batch (e.g. of another watcher) may be downloading the same file, wait for it instead.
+    own = []
+    shared = []
+    with _inflight_lock:
+        for r in todo:
+            owner = _inflight.get(r.getIndex().getCacheFileName())
+            if owner is None:
+                _inflight[r.getIndex().getCacheFileName()] = r
+                own.append(r)
+            else:
+                shared.append((r, owner))
+
+    try:
+        if len(own) > 0:
+            pixiv_oauth.auto_token_valid_guard(app, conf)
+            session = _get_session(conf)
+            workers = max(1, min(conf.download_worker_count, len(own)))
+            with _ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+                for _ in pool.map(lambda r: _download_one(session, conf, r), own):
+                    pass
+    finally:
+        with _inflight_lock:
+            for r in own:
+                _inflight.pop(r.getIndex().getCacheFileName(), None)
+        for r in own:
+            r._done.set()
+
+    for r, owner in shared:
+        if not owner._done.wait(conf.download_timeout * (conf.ratelimit_max_retries + 1)):
+            r._error = "timed out waiting for shared download"
+            continue
+        r._success = owner._success
+        r._size = owner._size
+        r._checksum = owner._checksum
+        r._error = owner._error
+        log.debug(f"{r.getIndex().getParent().getPid()}_{r.getIndex().getIndex()} - Shared download of "
+                  f"another batch is used.")
+
+    failed = sum(1 for r in todo if not r.isSuccess())
+    if failed > 0:
+        log.warn(f"{failed} of {len(todo)} image(s) failed to download.")
+    return results
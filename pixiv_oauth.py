@@ -1,14 +1,28 @@
-import datetime
+import json as _json
 import os
+import threading
 import time
+import typing
 from typing import cast as _cast
 import log
 import log as _log
+import metrics
 import pixivpy3 as _pixiv
 import config as _config
-import gppt as _gppt
 
-_last_testment: int = 0
+if typing.TYPE_CHECKING:
+    import gppt as _gppt  # Imported by password login only, it pulls in a whole browser automation stack
+
+# Token lifecycle. Access token is refreshed with refresh_token grant shortly before it expires, and password
+# login (gppt) is only used when refresh token has been rejected. Concurrent refresh attempts are coalesced.
+_refresh_token_value: str = None
+_expires_at: float = 0  # Epoch seconds
+_generation: int = 0  # Increased by every successful refresh
+_refresh_lock = threading.Lock()
+_refresh_retry_cap = 30  # Seconds between refresh grant attempts at most
+
+# Parts of error message which mean access token is invalid, other errors must not trigger refreshing.
+_auth_error_keywords = ("oauth", "invalid_grant", "invalid_token", "access token")
 
 
 def _cache_userinfo_path(conf: _config.BotConf) -> str:
@@ -16,61 +30,156 @@ def _cache_userinfo_path(conf: _config.BotConf) -> str:
     return config.cache_path + f"/login_info_{conf.pixiv_user_name}.json"
 
 
-def _fetch_cache(conf: _config.BotConf) -> _gppt.LoginInfo:
-    import json
+def _fetch_cache(conf: _config.BotConf) -> "_gppt.LoginInfo":
     p = _cache_userinfo_path(conf)
     if os.path.isfile(p):
         with open(p, "r") as login_cache:
-            res = _cast(_gppt.LoginInfo, json.load(login_cache))
+            res = _cast("_gppt.LoginInfo", _json.load(login_cache))
+            if "obtained_at" not in res:
+                res["obtained_at"] = os.path.getmtime(p)  # Cached before expiry was tracked
             _log.debug("Found cached user info.")
             return res
     return None
 
 
-def _refresh_token(conf: _config.BotConf) -> _gppt.LoginInfo:
-    import json
-
+def _write_cache(conf: _config.BotConf, inf: "_gppt.LoginInfo"):
     p = _cache_userinfo_path(conf)
+    tmp = p + ".tmp"
+    with open(tmp, "w") as login_cache:
+        login_cache.write(_json.dumps(inf))
+    os.replace(tmp, p)
+
+
+def _login_with_password(conf: _config.BotConf) -> "_gppt.LoginInfo":
     _log.process(f"Attempting login as '{conf.pixiv_user_name}'")
     if conf.pixiv_user_pwd is None:
         raise ValueError("'pixiv_user_pwd' was required to refresh user info!")
 
-    g = _gppt.GetPixivToken()
-    r: _gppt.LoginInfo
+    import gppt
+    g = gppt.GetPixivToken()
+    r: "_gppt.LoginInfo"
     st = 1
+    attempt = 1
     while True:
         try:
             r = g.login(True, conf.pixiv_user_name, conf.pixiv_user_pwd)
             break
         except Exception as e:
+            if attempt >= conf.token_login_max_attempts:
+                raise
             log.failed(f"Failed to login in, Try again in {st}s. Details: {e}")
             time.sleep(st)
-            st *= 2
-            if st > 120:
-                st = 120
+            st = min(st * 2, 120)
+            attempt += 1
             _log.process(f"Attempting login as '{conf.pixiv_user_name}' again")
-            continue
-
-    _log.debug(f"Get access_token={r['access_token']}")
-    _log.debug(f"Get refresh_token={r['refresh_token']}")
-
-    # Update cache info
-    if os.path.exists(p):
-        os.remove(p)
-    with open(p, "x") as login_cache:
-        login_cache.write(json.dumps(r))
 
+    r["obtained_at"] = time.time()
     _log.success(f"login as '{conf.pixiv_user_name}'")
-    global _last_testment
-    import typing
-    _last_testment = typing.cast(int, datetime.datetime.now().timestamp())
     return r
 
 
-def _update_app(app: _pixiv.AppPixivAPI, conf: _config.BotConf, inf: _gppt.LoginInfo):
+def _login_with_refresh_token(app: _pixiv.AppPixivAPI, refresh_token: str) -> "_gppt.LoginInfo":
+    token = app.auth(refresh_token=refresh_token)
+    token = token.get("response", token)
+    return _cast("_gppt.LoginInfo", {
+        "access_token": token["access_token"],
+        "refresh_token": token["refresh_token"],
+        "expires_in": token.get("expires_in", 3600),
+        "user": dict(token["user"]),
+        "obtained_at": time.time(),
+    })
+
+
+def _is_refresh_token_rejected(e: _pixiv.PixivError) -> bool:
+    """
+    OAuth server answers a revoked or expired refresh token with 400 invalid_grant. pixivpy3 raises PixivError
+    for network errors and 5xx as well, those say nothing about the token.
+    """
+    return ("HTTP 400" in e.reason) and ("invalid_grant" in (e.body or ""))
+
+
+def _refresh_with_retry(app: _pixiv.AppPixivAPI, conf: _config.BotConf, refresh_token: str) -> "_gppt.LoginInfo":
+    """Refresh grant, retried with backoff unless the refresh token was rejected. None if it was rejected."""
+    st = 1
+    attempt = 1
+    while True:
+        try:
+            return _login_with_refresh_token(app, refresh_token)
+        except _pixiv.PixivError as e:
+            metrics.token_refresh_failures.inc()
+            if _is_refresh_token_rejected(e):
+                _log.warn(f"Refresh token was rejected, password login is required: {e}")
+                return None
+            if attempt >= conf.token_refresh_max_attempts:
+                raise
+            _log.warn(f"Failed to refresh access token, try again in {st}s. Details: {e}")
+            time.sleep(st)
+            st = min(st * 2, _refresh_retry_cap)
+            attempt += 1
+
+
+def _update_app(app: _pixiv.AppPixivAPI, conf: _config.BotConf, inf: "_gppt.LoginInfo"):
+    global _refresh_token_value, _expires_at
     if conf.pixiv_user_watch_uid is None:
         conf.pixiv_user_watch_uid = inf["user"]["id"]
     app.set_auth(access_token=inf["access_token"], refresh_token=inf["refresh_token"])
+    _refresh_token_value = inf["refresh_token"]
+    _expires_at = inf.get("obtained_at", time.time()) + inf.get("expires_in", 3600)
+
+
+def load_cached_token(app: _pixiv.AppPixivAPI, conf: _config.BotConf) -> bool:
+    """
+    Use cached login info without any request if its access token is not going to expire within
+    token_refresh_margin. A token revoked before its expiry is refreshed by the first request it fails.
+    """
+    inf = _fetch_cache(conf)
+    if inf is None:
+        return False
+    _update_app(app, conf, inf)
+    return get_expires_in() > conf.token_refresh_margin
+
+
+def get_expires_in() -> float:
+    return _expires_at - time.time()
+
+
+def get_generation() -> int:
+    return _generation
+
+
+def refresh(app: _pixiv.AppPixivAPI, conf: _config.BotConf, seen_generation: int = None) -> "_gppt.LoginInfo":
+    """
+    Refresh access token. Concurrent callers are coalesced, a caller which saw an older generation than the
+    current one does not refresh again but uses the token refreshed by others.
+    """
+    global _generation
+    if seen_generation is None:
+        seen_generation = _generation
+    with _refresh_lock:
+        if _generation != seen_generation:
+            return None  # Refreshed by another caller while waiting
+
+        res = None
+        if _refresh_token_value is not None:
+            # Network and server errors are raised after retries, only a rejected token falls back to password.
+            res = _refresh_with_retry(app, conf, _refresh_token_value)
+            if res is not None:
+                metrics.token_refreshes.inc("refresh_token")
+                _log.debug("Access token was refreshed with refresh token.")
+        if res is None:
+            try:
+                res = _login_with_password(conf)
+            except Exception:
+                metrics.token_refresh_failures.inc()
+                raise
+            metrics.token_refreshes.inc("password")
+
+        _log.debug(f"Get access_token={res['access_token']}")
+        _log.debug(f"Get refresh_token={res['refresh_token']}")
+        _update_app(app, conf, res)
+        _write_cache(conf, res)
+        _generation += 1
+        return res
 
 
 def validate_response(json: dict, warn: bool = True) -> bool:
@@ -81,27 +190,42 @@ def validate_response(json: dict, warn: bool = True) -> bool:
     return True
 
 
-def should_retry_response(app: _pixiv.AppPixivAPI, conf: _config.BotConf, json: dict, warn: bool = True) -> bool:
+def is_auth_error(json: dict) -> bool:
+    if (not isinstance(json, dict)) or ("error" not in json):
+        return False
+    err = json["error"] or {}
+    msg = f"{err.get('message', '')} {err.get('reason', '')}".lower()
+    return any(k in msg for k in _auth_error_keywords)
+
+
+def is_rate_limited(json) -> bool:
+    """Pixiv answers throttled requests with 'Rate Limit' error, which has nothing to do with login info."""
+    if (not isinstance(json, dict)) or ("error" not in json):
+        return False
+    err = json["error"] or {}
+    return "rate limit" in f"{err.get('message', '')} {err.get('reason', '')}".lower()
+
+
+def should_retry_response(app: _pixiv.AppPixivAPI, conf: _config.BotConf, json: dict, warn: bool = True,
+                          seen_generation: int = None) -> bool:
+    """
+    Refresh token if response was rejected for authentication, returns True if request should be redone.
+    seen_generation is get_generation() before the request, so a token refreshed meanwhile is not refreshed again.
+    """
     if validate_response(json, warn):
         return False
+    if is_rate_limited(json) or (not is_auth_error(json)):
+        return False  # Not an authentication problem, refreshing would not help.
     _log.process("Login info was rejected. Require refreshing.")
-    res = _refresh_token(conf)
-    _update_app(app, conf, res)
+    refresh(app, conf, seen_generation)
     _log.success("Refreshed. Action should being redo.")
     return True
 
 
-def token_valid_guard(app: _pixiv.AppPixivAPI, conf: _config.BotConf):
-    test = app.user_detail(conf.pixiv_user_watch_uid)
-    should_retry_response(app, conf, test, False)
-
-
 def auto_token_valid_guard(app: _pixiv.AppPixivAPI, conf: _config.BotConf):
-    global _last_testment
-    import typing
-    t = typing.cast(int, datetime.datetime.now().timestamp())
-    if t - _last_testment > conf.token_expired_test_interval:
-        _log.debug("Token will being test for time expired.")
-        token_valid_guard(app, conf)
-        _last_testment = t
-
+    """Refresh token if it expires within token_refresh_margin seconds. No request is made otherwise."""
+    seen = _generation
+    if time.time() < _expires_at - conf.token_refresh_margin:
+        return
+    _log.debug("Token will being refreshed for expiring.")
+    refresh(app, conf, seen)
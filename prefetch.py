@@ -0,0 +1,65 @@
+import threading
+import pixivpy3 as _pixiv
+import config as _config
+import imgcache
+import log
+import metrics
+import picdb
+import ratelimit
+
+# Only one prefetch runs at a time, a watcher finding another one running just skips its own.
+_lock = threading.Lock()
+
+
+def _cached_bytes(indexes: list) -> int:
+    total = 0
+    for i in indexes:
+        e = imgcache.get(i.getCacheFileName())
+        if e is not None:
+            total += e.getSize()
+    return total
+
+
+def _has_spare_tokens(conf: _config.BotConf) -> bool:
+    # Low priority: leave at least half of the burst of image bucket to sending cycles.
+    bucket = ratelimit.get_image_bucket(conf)
+    return bucket.getAvailable() >= bucket.getBurst() / 2
+
+
+def prefetch_pending(app: _pixiv.AppPixivAPI, conf: _config.BotConf) -> int:
+    """
+    Download pending outbox items of the next prefetch_lookahead cycles of the watcher into image cache, one at a
+    time. Stops once prefetch_max_mb has been downloaded, prefetched images would take more than
+    prefetch_cache_share of cache budget, or image requests are busy. Returns bytes downloaded.
+    """
+    if (conf.prefetch_max_mb <= 0) or (conf.prefetch_lookahead <= 0):
+        return 0
+    if not _lock.acquire(blocking=False):
+        return 0
+    try:
+        pending = picdb.peek_outbox(conf.watcher_name, conf.check_bookmark_new_sending_limit * conf.prefetch_lookahead)
+        share = imgcache.get_budget() * conf.prefetch_cache_share if imgcache.get_budget() > 0 else None
+        held = _cached_bytes(pending)
+        cap = conf.prefetch_max_mb * 1024 * 1024
+        downloaded = 0
+        count = 0
+        for idx in pending:
+            if (downloaded >= cap) or ((share is not None) and (held >= share)):
+                break
+            if not idx.getParent().isPublic() or imgcache.get(idx.getCacheFileName()) is not None:
+                continue
+            if not _has_spare_tokens(conf):
+                log.debug("Prefetch yields to busy image requests.")
+                break
+            r = picdb.create_caches(app, conf, [idx])[0]
+            if r.isSuccess():
+                downloaded += r.getSize()
+                held += r.getSize()
+                count += 1
+        if count > 0:
+            metrics.prefetch_bytes.inc(amount=downloaded)
+            log.debug(f"Prefetched {count} image(s) of upcoming cycles ({downloaded} bytes).",
+                      watcher=conf.watcher_name)
+        return downloaded
+    finally:
+        _lock.release()
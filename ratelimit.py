@@ -0,0 +1,223 @@
+import random
+import threading
+import time
+import pixivpy3 as _pixiv
+import config as _config
+import log
+import metrics
+import pixiv_oauth
+
+# Methods of AppPixivAPI which never touch the network and must not consume budget.
+_local_methods = frozenset((
+    "set_auth", "set_client", "set_accept_language", "set_additional_headers", "set_api_proxy",
+    "require_auth", "parse_qs", "format_bool",
+))
+
+_api_bucket: "TokenBucket" = None
+_image_bucket: "TokenBucket" = None
+_bucket_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Refill rate is adaptive: it is halved whenever a request was throttled by the
+    server and recovers slowly on success, so sustained throughput settles just under the real limit.
+    """
+    _name: str
+    _max_rate: float  # Tokens per second as configured
+    _min_rate: float
+    _rate: float
+    _burst: float
+    _tokens: float
+    _stamp: float
+    _paused_until: float
+    _lock: threading.Lock
+    _acquired: int
+    _throttled: int
+    _waited: float
+
+    def __init__(self, name: str, rate: float, burst: float):
+        if rate <= 0:
+            raise ValueError(f"Rate of '{name}' bucket must be positive!")
+        self._name = name
+        self._max_rate = rate
+        self._min_rate = rate / 16
+        self._rate = rate
+        self._burst = max(1.0, burst)
+        self._tokens = self._burst
+        self._stamp = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self._throttled = 0
+        self._waited = 0
+
+    def _fill(self, now: float):
+        if now > self._stamp:
+            self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+            self._stamp = now
+
+    def acquire(self, n: float = 1) -> float:
+        """Block until n tokens are available, returns seconds waited."""
+        waited = 0
+        with self._lock:
+            now = time.monotonic()
+            self._fill(now)
+            self._tokens -= n  # Reserve now, callers are served in arrival order.
+            wait = max(-self._tokens / self._rate, self._paused_until - now, 0)
+            self._acquired += 1
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            with self._lock:
+                wait = self._paused_until - time.monotonic()  # Server may have throttled us meanwhile
+        if waited > 0:
+            with self._lock:
+                self._waited += waited
+        return waited
+
+    def throttle(self, pause: float):
+        """Server refused a request for rate, pause every caller for given seconds and slow down."""
+        with self._lock:
+            now = time.monotonic()
+            self._fill(now)
+            self._rate = max(self._min_rate, self._rate / 2)
+            self._tokens = min(self._tokens, 0)
+            self._paused_until = max(self._paused_until, now + pause)
+            self._throttled += 1
+
+    def recover(self):
+        """A request went through, speed up towards the configured rate again."""
+        if self._rate >= self._max_rate:
+            return
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._max_rate / 20)
+
+    def getName(self) -> str:
+        return self._name
+
+    def getRate(self) -> float:
+        return self._rate
+
+    def getMaxRate(self) -> float:
+        return self._max_rate
+
+    def getBurst(self) -> float:
+        return self._burst
+
+    def getAvailable(self) -> float:
+        """Tokens which can be taken without waiting, negative when callers are queued."""
+        with self._lock:
+            now = time.monotonic()
+            self._fill(now)
+            if self._paused_until > now:
+                return min(self._tokens, 0)
+            return self._tokens
+
+    def getPausedFor(self) -> float:
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def getBudget(self) -> dict:
+        return {
+            "available": self.getAvailable(),
+            "rate": self._rate,
+            "max_rate": self._max_rate,
+            "burst": self._burst,
+            "paused_for": self.getPausedFor(),
+            "acquired": self._acquired,
+            "throttled": self._throttled,
+            "waited": self._waited,
+        }
+
+
+def get_api_bucket(conf: _config.BotConf) -> TokenBucket:
+    global _api_bucket
+    with _bucket_lock:
+        if _api_bucket is None:
+            _api_bucket = TokenBucket("api", conf.ratelimit_api_rate, conf.ratelimit_api_burst)
+        return _api_bucket
+
+
+def get_image_bucket(conf: _config.BotConf) -> TokenBucket:
+    global _image_bucket
+    with _bucket_lock:
+        if _image_bucket is None:
+            _image_bucket = TokenBucket("image", conf.ratelimit_image_rate, conf.ratelimit_image_burst)
+        return _image_bucket
+
+
+def get_budget() -> dict:
+    """Current budget of every bucket which has been used."""
+    return {b.getName(): b.getBudget() for b in (_api_bucket, _image_bucket) if b is not None}
+
+
+_tokens_gauge = metrics.Gauge("ratelimit_tokens_available", "Tokens which can be taken without waiting.",
+                              ("bucket",), func=lambda: {n: b["available"] for n, b in get_budget().items()})
+_rate_gauge = metrics.Gauge("ratelimit_rate", "Current refill rate of bucket in requests per second.", ("bucket",),
+                            func=lambda: {n: b["rate"] for n, b in get_budget().items()})
+
+
+def backoff_delay(attempt: int, conf: _config.BotConf) -> float:
+    """Capped exponential backoff, jittered within its upper half. attempt starts from 0."""
+    ceiling = min(conf.ratelimit_backoff_cap, conf.ratelimit_backoff_base * (2 ** attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class RateLimitedApp:
+    """
+    Wraps AppPixivAPI, every network call takes a token first. download() takes from the image bucket and
+    everything else from the API bucket. A rate limited response is retried with backoff before it is returned,
+    so callers only see it when retries were exhausted.
+    """
+    _app: _pixiv.AppPixivAPI
+    _conf: _config.BotConf
+
+    def __init__(self, app: _pixiv.AppPixivAPI, conf: _config.BotConf):
+        object.__setattr__(self, "_app", app)
+        object.__setattr__(self, "_conf", conf)
+
+    def getApp(self) -> _pixiv.AppPixivAPI:
+        return self._app
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._app, name)
+        if (not callable(attr)) or name.startswith("_") or (name in _local_methods):
+            return attr
+        bucket = get_image_bucket(self._conf) if name == "download" else get_api_bucket(self._conf)
+
+        def _limited(*args, **kwargs):
+            return self._call(name, bucket, attr, args, kwargs)
+
+        return _limited
+
+    def __setattr__(self, name: str, value):
+        setattr(self._app, name, value)
+
+    def _call(self, name: str, bucket: TokenBucket, func, args, kwargs):
+        attempt = 0
+        while True:
+            bucket.acquire()
+            metrics.api_requests.inc(name)
+            st = time.perf_counter()
+            try:
+                res = func(*args, **kwargs)
+            except Exception:
+                metrics.api_errors.inc(name, "exception")
+                raise
+            finally:
+                metrics.api_seconds.observe(time.perf_counter() - st, name)
+            if not pixiv_oauth.is_rate_limited(res):
+                bucket.recover()
+                if pixiv_oauth.is_auth_error(res):
+                    metrics.api_errors.inc(name, "auth")
+                elif isinstance(res, dict) and ("error" in res):
+                    metrics.api_errors.inc(name, "other")
+                return res
+            metrics.api_errors.inc(name, "rate_limit")
+            delay = backoff_delay(attempt, self._conf)
+            bucket.throttle(delay)
+            if attempt >= self._conf.ratelimit_max_retries:
+                log.failed(f"Rate limited on '{name}' after {attempt + 1} attempt(s), giving up.")
+                return res
+            log.warn(f"Rate limited on '{name}', retry in {delay:.1f}s with {bucket.getRate():.2f} req/s.")
+            attempt += 1
@@ -0,0 +1,192 @@
+import asyncio
+import random
+
+import log
+import metrics
+
+
+async def run_blocking(func, *args, executor=None):
+    """
+    Run func in executor (default executor if None) and return its result. A call being cancelled waits until
+    func has returned before it raises, since a thread can not be stopped. So a coroutine job which is cancelled
+    for its timeout stays running, and keeps what it holds, until the work it handed to threads has finished.
+    """
+    fut = asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        await asyncio.wait([fut])
+        raise
+
+
+class Job:
+    _name: str
+    _func: object
+    _interval: float
+    _jitter: float
+    _timeout: float
+    _delay: float
+    _next_run: float  # In event loop time
+    _task: asyncio.Task
+    _runs: int
+    _skips: int
+
+    def getName(self) -> str:
+        return self._name
+
+    def getInterval(self) -> float:
+        return self._interval
+
+    def getNextRun(self) -> float:
+        return self._next_run
+
+    def isRunning(self) -> bool:
+        return (self._task is not None) and (not self._task.done())
+
+    def getRunCount(self) -> int:
+        return self._runs
+
+    def getSkipCount(self) -> int:
+        return self._skips
+
+
+class Scheduler:
+    """
+    Job scheduler living in the event loop which is shared with Mirai updater. The loop sleeps until the next
+    job is due instead of polling. Coroutine jobs run in the loop and blocking jobs run in the default executor.
+    A job never overlaps with its previous run. A coroutine job exceeding its timeout is cancelled and a blocking
+    one is abandoned (not killed), either of them is still running until it has actually stopped.
+    """
+    _jobs: list
+    _loop: asyncio.AbstractEventLoop
+    _wakeup: asyncio.Event
+    _stopped: bool
+
+    def __init__(self):
+        self._jobs = []
+        self._loop = None
+        self._wakeup = None
+        self._stopped = False
+
+    def every(self, interval: float, func, name: str = None, jitter: float = 0, timeout: float = None,
+              delay: float = 0) -> Job:
+        """
+        Run func every interval seconds. Each run is postponed by a random time in [0, jitter) seconds and
+        the first run happens after delay seconds.
+        """
+        if interval <= 0:
+            raise ValueError("Interval of scheduled job must be positive!")
+        j = Job()
+        j._name = name or getattr(func, "__name__", "job")
+        j._func = func
+        j._interval = interval
+        j._jitter = max(0.0, jitter)
+        j._timeout = timeout
+        j._next_run = None if self._loop is None else self._loop.time() + delay
+        j._delay = delay
+        j._task = None
+        j._runs = 0
+        j._skips = 0
+        self._jobs.append(j)
+        self._notify()
+        return j
+
+    def getJobs(self) -> list:
+        return list(self._jobs)
+
+    def _notify(self):
+        if (self._loop is None) or (self._wakeup is None) or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        """Serve jobs until shutdown() is called."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        now = self._loop.time()
+        for j in self._jobs:
+            if j._next_run is None:
+                j._next_run = now + j._delay
+
+        while not self._stopped:
+            now = self._loop.time()
+            for j in self._jobs:
+                if j._next_run <= now:
+                    self._start(j, now)
+
+            self._wakeup.clear()
+            timeout = None
+            if len(self._jobs) > 0:
+                timeout = max(0.0, min(j._next_run for j in self._jobs) - self._loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, job: Job, now: float):
+        due = job._next_run
+        job._next_run = due + job._interval + random.uniform(0, job._jitter)
+        if job._next_run <= now:
+            job._next_run = now + job._interval  # Do not try to catch up missed runs
+        if job.isRunning():
+            job._skips += 1
+            metrics.scheduler_skips.inc(job._name)
+            log.warn(f"Scheduled job '{job._name}' is still running, this run is skipped.")
+            return
+        job._task = self._loop.create_task(self._execute(job, now - due))
+
+    async def _execute(self, job: Job, lag: float):
+        job._runs += 1
+        metrics.scheduler_lag.observe(lag, job._name)
+        st = self._loop.time()
+        if lag > 1:
+            log.debug(f"Scheduled job '{job._name}' started {lag:.2f}s late.")
+        try:
+            if asyncio.iscoroutinefunction(job._func):
+                # On timeout wait_for cancels the job and waits until it has stopped, which includes work it is
+                # waiting for in threads through run_blocking().
+                await asyncio.wait_for(job._func(), job._timeout)
+            else:
+                fut = self._loop.run_in_executor(None, job._func)
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), job._timeout)
+                except asyncio.TimeoutError:
+                    log.failed(f"Scheduled job '{job._name}' exceeded timeout of {job._timeout}s. "
+                               f"Next run waits until it returns.")
+                    await fut  # A thread can not be killed, keep the job marked as running.
+                    return
+                except asyncio.CancelledError:
+                    await asyncio.wait([fut])  # Cancelled by shutdown, which waits until the thread returns.
+                    raise
+        except asyncio.TimeoutError:
+            log.failed(f"Scheduled job '{job._name}' exceeded timeout of {job._timeout}s and was cancelled.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.failed(f"Found error while process scheduled job '{job._name}': {e}")
+            log.print_recent_err()
+        finally:
+            metrics.scheduler_job_seconds.observe(self._loop.time() - st, job._name)
+
+    def shutdown(self):
+        """Stop serving and cancel running jobs, blocking ones are waited for. Safe to call from any thread."""
+        self._stopped = True
+        if self._loop is None:
+            return
+
+        def _cancel():
+            for j in self._jobs:
+                if j.isRunning():
+                    j._task.cancel()
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+        if self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(_cancel)
+
+    async def wait_closed(self, timeout: float = None):
+        """Wait for running jobs to finish after shutdown()."""
+        tasks = [j._task for j in self._jobs if j.isRunning()]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks, timeout=timeout)
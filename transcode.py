@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
+import config as _config
+import imgcache
+import log
+import scheduler
+
+try:
+    from PIL import Image as _PILImage
+except ImportError:
+    _PILImage = None
+
+_pool: _ProcessPoolExecutor = None
+_pool_lock = threading.Lock()
+
+
+def is_available() -> bool:
+    return _PILImage is not None
+
+
+def get_profile_name(conf: _config.BotConf) -> str:
+    return f"{conf.upload_max_edge}q{conf.upload_jpeg_quality}"
+
+
+def get_variant_file_name(conf: _config.BotConf, index) -> str:
+    # '12345_p0.png' -> '12345_p0.2048q85.jpg', stays next to the original and keeps its pid/index prefix.
+    stem = os.path.splitext(index.getCacheFileName())[0]
+    return f"{stem}.{get_profile_name(conf)}.jpg"
+
+
+def _get_pool(conf: _config.BotConf) -> _ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _ProcessPoolExecutor(max_workers=max(1, conf.transcode_worker_count))
+        return _pool
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _transcode_file(src: str, dst: str, max_edge: int, quality: int) -> tuple:
+    """Runs in worker process. Downscale and re-encode src into JPEG at dst, returns (size, sha1)."""
+    part = dst + ".part"
+    with _PILImage.open(src) as img:
+        img.draft("RGB", (max_edge, max_edge))  # Cheap JPEG decoding at lower scale
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            bg = _PILImage.new("RGB", img.size, (255, 255, 255))
+            bg.paste(img, mask=img.getchannel("A"))
+            img = bg
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_edge, max_edge), _PILImage.LANCZOS)
+        img.save(part, "JPEG", quality=quality, optimize=True, progressive=True)
+    os.replace(part, dst)  # Never expose a half written variant
+
+    h = hashlib.sha1()
+    with open(dst, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return os.path.getsize(dst), h.hexdigest()
+
+
+def _dhash_file(src: str) -> int:
+    """
+    Runs in worker process. 64 bit difference hash of src: each bit tells whether a pixel of a 9x8 grayscale
+    thumbnail is brighter than its right neighbour, so re-encoding or resizing barely changes it.
+    """
+    with _PILImage.open(src) as img:
+        img.draft("L", (64, 64))
+        px = list(img.convert("L").resize((9, 8), _PILImage.LANCZOS).getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+
+async def hash_images(conf: _config.BotConf, indexes: list) -> dict:
+    """dHash of each cached ImageRecordIndex, computed in worker processes. Those which failed are left out."""
+    if not is_available():
+        return {}
+    async def _hash_one(index):
+        try:
+            return await scheduler.run_blocking(_dhash_file, index.getCacheLocalFilePath(), executor=_get_pool(conf))
+        except Exception as e:
+            log.warn(f"{index.getParent().getPid()}_{index.getIndex()} - Failed to hash image: {e}",
+                     pid=index.getParent().getPid(), index=index.getIndex(), stage="dedup")
+            return None
+
+    hashes = await asyncio.gather(*[_hash_one(i) for i in indexes])
+    return {i: h for i, h in zip(indexes, hashes) if h is not None}
+
+
+def _register_variant(name: str, index, size: int, checksum: str):
+    imgcache.put(name, index.getParent().getPid(), index.getIndex(), size, checksum)
+
+
+async def _prepare_one(conf: _config.BotConf, index) -> str:
+    src = index.getCacheLocalFilePath()
+    entry = imgcache.get(index.getCacheFileName())
+    if (entry is not None) and (entry.getSize() <= conf.upload_transcode_min_kb * 1024):
+        return src  # Small enough to be sent as is
+
+    name = get_variant_file_name(conf, index)
+    dst = _config.cache_path + f"/{name}"
+    if imgcache.has(name) and not await scheduler.run_blocking(imgcache.discard_missing, name):
+        await scheduler.run_blocking(imgcache.touch, name)
+        return dst
+
+    tag = f"{index.getParent().getPid()}_{index.getIndex()}"
+    try:
+        size, checksum = await scheduler.run_blocking(_transcode_file, src, dst, conf.upload_max_edge,
+                                                      conf.upload_jpeg_quality, executor=_get_pool(conf))
+    except Exception as e:
+        log.warn(f"{tag} - Failed to transcode, original will be sent: {e}", pid=index.getParent().getPid(),
+                 index=index.getIndex(), stage="transcode")
+        await scheduler.run_blocking(imgcache.discard_missing, index.getCacheFileName())
+        return src
+
+    if (entry is not None) and (size >= entry.getSize()):
+        os.remove(dst)  # Re-encoding did not help
+        return src
+    await scheduler.run_blocking(_register_variant, name, index, size, checksum)
+    log.debug(f"{tag} - Transcoded to {name} ({size} bytes)", pid=index.getParent().getPid(),
+              index=index.getIndex(), stage="transcode", size=size)
+    return dst
+
+
+async def prepare_uploads(conf: _config.BotConf, indexes: list) -> dict:
+    """
+    Make upload variant of each cached ImageRecordIndex in worker processes, derived variants are cached and
+    reused. Returns a dict of index to the file path which should be uploaded.
+    """
+    if (not conf.upload_transcode) | (not is_available()):
+        return {i: i.getCacheLocalFilePath() for i in indexes}
+    paths = await asyncio.gather(*[_prepare_one(conf, i) for i in indexes])
+    return dict(zip(indexes, paths))